@@ -1,20 +1,70 @@
+import asyncio
+import logging
+import time
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
-from db.config import engine, Base
+from compression import CompressionMiddleware
+from db.config import SCHEMA_MODE, CASHE_WARMUP, CASHE_WARMUP_CONCURRENCY, CASHE_WARMUP_MENUS, CASHE_WRITE_BEHIND
+from db.config import COMPRESSION_MINIMUM_SIZE, COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY
+from db.cashe import cashe, changes
+from db.dals.book_dal import warm_up
+from db.migrations import prepare_schema
+import metrics
 from routers import book_router
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+# seconds shutdown waits for queued cache invalidations and change events
+WRITE_BEHIND_DRAIN_TIMEOUT = 5
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.include_router(book_router.router)
+app.add_middleware(
+    CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL, brotli_quality=COMPRESSION_BROTLI_QUALITY,
+)
+# added last so it is outermost and times the compression too
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return metrics.metrics_response()
 
 
 @app.on_event("startup")
 async def startup():
-    # create db tables
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
+    # check or migrate the schema, never drops data unless SCHEMA_MODE=recreate
+    await prepare_schema(SCHEMA_MODE)
+    # local cache invalidation from other workers
+    app.state.cashe_listener = asyncio.create_task(cashe.listen_invalidations())
+    # changes from every worker for this one's change feed clients
+    app.state.changes_listener = asyncio.create_task(changes.listen_changes())
+    # cache invalidations of writes, applied after their responses
+    app.state.cashe_writer = asyncio.create_task(cashe.run_write_behind()) if CASHE_WRITE_BEHIND else None
+    if CASHE_WARMUP:
+        # requests are only accepted once startup returns
+        started = time.monotonic()
+        try:
+            menus = await warm_up(CASHE_WARMUP_CONCURRENCY, CASHE_WARMUP_MENUS)
+        except Exception:
+            logger.exception("cache warm-up failed, starting with a cold cache")
+        else:
+            logger.info("warmed the cache with %s menus in %.2fs", menus, time.monotonic() - started)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.cashe_writer is not None:
+        await cashe.drain_write_behind(WRITE_BEHIND_DRAIN_TIMEOUT)
+        app.state.cashe_writer.cancel()
+    app.state.cashe_listener.cancel()
+    app.state.changes_listener.cancel()
 
 
 if __name__ == '__main__':
+    # development, one process reloaded on changes; server.py runs the workers in production
     uvicorn.run("app:app", port=8000, host='127.0.0.1', reload=True)
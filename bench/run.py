@@ -0,0 +1,303 @@
+"""In-process benchmark of the menu API.
+
+Drives app.app through an ASGI client against sqlite+aiosqlite (or --database-url) and
+an in-memory Redis, so it runs without network access:
+
+    pip install -r requirements.txt -r bench/requirements.txt
+    python -m bench.run --output bench.json
+
+Prints one JSON report with throughput and p50/p95/p99 latency per route and scenario.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+import uuid
+
+import orjson
+
+from bench import standins
+
+MENUS = "GET /api/v1/menus"
+MENU = "GET /api/v1/menus/{id}"
+TREE = "GET /api/v1/menus/{id}/tree"
+SUBMENUS = "GET /api/v1/menus/{id}/submenus/"
+SUBMENU = "GET /api/v1/menus/{id}/submenus/{id}"
+DISHES = "GET /api/v1/menus/{id}/submenus/{id}/dishes"
+DISHES_STREAM = "GET /api/v1/menus/{id}/submenus/{id}/dishes?stream=true"
+DISH = "GET /api/v1/menus/{id}/submenus/{id}/dishes/{id}"
+PATCH_MENU = "PATCH /api/v1/menus/{id}"
+PATCH_SUBMENU = "PATCH /api/v1/menus/{id}/submenus/{id}"
+PATCH_DISH = "PATCH /api/v1/menus/{id}/submenus/{id}/dishes/{id}"
+POST_DISH = "POST /api/v1/menus/{id}/submenus/{id}/dishes"
+IMPORT = "POST /api/v1/import"
+EXPORT = "GET /api/v1/export"
+
+SCENARIOS = ["cold", "warm", "mixed", "invalidation_storm", "large_menu"]
+
+
+class Catalog():
+    # ids of the seeded rows, (menu_id, submenu_id, dish_id) for dishes
+    def __init__(self):
+        self.menus = []
+        self.submenus = []
+        self.dishes = []
+        self.large_menu = None
+
+    def seed_records(self, menus, submenus, dishes, large_dishes):
+        for m in range(menus):
+            menu_id = seed_id("m%s" % m)
+            self.menus.append(menu_id)
+            yield {"type": "menu", "id": menu_id, "title": "Menu %s" % m, "description": "menu %s" % m}
+            for s in range(submenus):
+                submenu_id = seed_id("m%s-s%s" % (m, s))
+                self.submenus.append((menu_id, submenu_id))
+                yield {"type": "submenu", "id": submenu_id, "main_menu_id": menu_id,
+                       "title": "Submenu %s" % s, "description": "submenu %s" % s}
+                for d in range(dishes):
+                    dish_id = seed_id("m%s-s%s-d%s" % (m, s, d))
+                    self.dishes.append((menu_id, submenu_id, dish_id))
+                    yield {"type": "dish", "id": dish_id, "submenu_id": submenu_id,
+                           "title": "Dish %s" % d, "description": "dish %s" % d, "price": "%s.50" % d}
+        if large_dishes:
+            self.large_menu = (seed_id("large"), seed_id("large-s0"))
+            menu_id, submenu_id = self.large_menu
+            yield {"type": "menu", "id": menu_id, "title": "Large", "description": "large menu"}
+            yield {"type": "submenu", "id": submenu_id, "main_menu_id": menu_id, "title": "Large", "description": "large"}
+            for d in range(large_dishes):
+                yield {"type": "dish", "id": seed_id("large-d%s" % d), "submenu_id": submenu_id,
+                       "title": "Dish %s" % d, "description": "dish %s" % d, "price": "%s.50" % d}
+
+
+def seed_id(name):
+    # ids are uuids, the same ones on every run
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "bench:" + name))
+
+
+class Recorder():
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, client, label, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            failed = response.status_code >= 400
+        except Exception:
+            response, failed = None, True
+        self.latencies.setdefault(label, []).append(time.perf_counter() - start)
+        if failed:
+            self.errors[label] = self.errors.get(label, 0) + 1
+        return response
+
+    def report(self, duration):
+        routes = {}
+        for label, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            routes[label] = {
+                "count": len(latencies),
+                "errors": self.errors.get(label, 0),
+                "throughput_rps": round(len(latencies) / duration, 1),
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "p99_ms": percentile(latencies, 99),
+            }
+        total = sum(route["count"] for route in routes.values())
+        return {
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(total / duration, 1),
+            "routes": routes,
+        }
+
+
+def percentile(latencies, p):
+    # nearest rank over sorted seconds, in milliseconds
+    index = max(0, min(len(latencies) - 1, -(-len(latencies) * p // 100) - 1))
+    return round(latencies[int(index)] * 1000, 3)
+
+
+def menu_url(menu_id):
+    return "/api/v1/menus/%s" % menu_id
+
+
+def submenu_url(menu_id, submenu_id):
+    return "/api/v1/menus/%s/submenus/%s" % (menu_id, submenu_id)
+
+
+def dish_url(menu_id, submenu_id, dish_id):
+    return "/api/v1/menus/%s/submenus/%s/dishes/%s" % (menu_id, submenu_id, dish_id)
+
+
+def random_read(rng, catalog):
+    choice = rng.random()
+    if choice < 0.1:
+        return MENUS, "GET", "/api/v1/menus", {}
+    if choice < 0.25:
+        return MENU, "GET", menu_url(rng.choice(catalog.menus)), {}
+    if choice < 0.35:
+        return TREE, "GET", menu_url(rng.choice(catalog.menus)) + "/tree", {}
+    if choice < 0.5:
+        return SUBMENUS, "GET", menu_url(rng.choice(catalog.menus)) + "/submenus/", {}
+    if choice < 0.6:
+        return SUBMENU, "GET", submenu_url(*rng.choice(catalog.submenus)), {}
+    if choice < 0.75:
+        return DISHES, "GET", submenu_url(*rng.choice(catalog.submenus)) + "/dishes", {}
+    return DISH, "GET", dish_url(*rng.choice(catalog.dishes)), {}
+
+
+def random_write(rng, catalog, menu_id=None):
+    dishes = [dish for dish in catalog.dishes if dish[0] == menu_id] if menu_id else catalog.dishes
+    menu_id, submenu_id, dish_id = rng.choice(dishes)
+    n = rng.randrange(1000)
+    choice = rng.random()
+    if choice < 0.6:
+        body = {"title": "Dish %s" % n, "description": "edited", "price": "%s.25" % n}
+        return PATCH_DISH, "PATCH", dish_url(menu_id, submenu_id, dish_id), {"json": body}
+    if choice < 0.8:
+        body = {"title": "Submenu %s" % n, "description": "edited"}
+        return PATCH_SUBMENU, "PATCH", submenu_url(menu_id, submenu_id), {"json": body}
+    if choice < 0.9:
+        body = {"title": "Menu %s" % n, "description": "edited"}
+        return PATCH_MENU, "PATCH", menu_url(menu_id), {"json": body}
+    body = {"title": "New dish %s" % n, "description": "created", "price": "%s.75" % n}
+    return POST_DISH, "POST", submenu_url(menu_id, submenu_id) + "/dishes", {"json": body}
+
+
+def scenario_operations(name, rng, catalog, requests):
+    if name == "cold":
+        # every request is the first read of its key after a flush
+        operations = [(MENUS, "GET", "/api/v1/menus", {})]
+        operations += [(MENU, "GET", menu_url(menu_id), {}) for menu_id in catalog.menus]
+        operations += [(TREE, "GET", menu_url(menu_id) + "/tree", {}) for menu_id in catalog.menus]
+        operations += [(SUBMENUS, "GET", menu_url(menu_id) + "/submenus/", {}) for menu_id in catalog.menus]
+        operations += [(SUBMENU, "GET", submenu_url(*submenu), {}) for submenu in catalog.submenus]
+        operations += [(DISHES, "GET", submenu_url(*submenu) + "/dishes", {}) for submenu in catalog.submenus]
+        operations += [(DISH, "GET", dish_url(*dish), {}) for dish in catalog.dishes]
+        rng.shuffle(operations)
+        return operations[:requests]
+    if name == "warm":
+        return [random_read(rng, catalog) for _ in range(requests)]
+    if name == "mixed":
+        return [random_write(rng, catalog) if rng.random() < 0.1 else random_read(rng, catalog) for _ in range(requests)]
+    if name == "invalidation_storm":
+        # half of the traffic rewrites one menu while the other half reads it
+        menu_id = catalog.menus[0]
+        hot = Catalog()
+        hot.menus = [menu_id]
+        hot.submenus = [submenu for submenu in catalog.submenus if submenu[0] == menu_id]
+        hot.dishes = [dish for dish in catalog.dishes if dish[0] == menu_id]
+        return [random_write(rng, catalog, menu_id) if rng.random() < 0.5 else random_read(rng, hot) for _ in range(requests)]
+    if name == "large_menu":
+        if catalog.large_menu is None:
+            return []
+        menu_id, submenu_id = catalog.large_menu
+        operations = [(TREE, "GET", menu_url(menu_id) + "/tree", {}) for _ in range(requests // 10)]
+        operations += [(DISHES, "GET", submenu_url(menu_id, submenu_id) + "/dishes?limit=500", {}) for _ in range(requests)]
+        operations += [
+            (DISHES_STREAM, "GET", submenu_url(menu_id, submenu_id) + "/dishes?stream=true", {}) for _ in range(requests // 10)
+        ]
+        operations.append((EXPORT, "GET", "/api/v1/export", {}))
+        rng.shuffle(operations)
+        return operations
+    raise ValueError("unknown scenario %r" % name)
+
+
+async def flush_caches():
+    from db.config import redis
+    from db.cashe import cashe
+    await redis.flushall()
+    cashe.local_cashe.clear()
+
+
+async def run_operations(client, operations, concurrency):
+    recorder = Recorder()
+    queue = iter(operations)
+
+    async def worker():
+        for label, method, url, kwargs in queue:
+            await recorder.request(client, label, method, url, **kwargs)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return recorder.report(time.perf_counter() - start)
+
+
+async def warm_up(client, catalog):
+    # read every key once so the warm scenarios start from a full cache
+    operations = scenario_operations("cold", random.Random(0), catalog, len(catalog.dishes) + len(catalog.submenus) * 2 + len(catalog.menus) * 3 + 1)
+    for label, method, url, kwargs in operations:
+        await client.request(method, url, **kwargs)
+
+
+async def main(args):
+    database_url = standins.use_database(args.database_url)
+    standins.use_fake_redis()
+    import httpx
+    import app
+
+    await app.app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench", timeout=None) as client:
+            catalog = Catalog()
+            records = b"".join(orjson.dumps(record) + b"\n" for record in catalog.seed_records(args.menus, args.submenus, args.dishes, args.large_dishes))
+            seed = Recorder()
+            response = await seed.request(client, IMPORT, "POST", "/api/v1/import", content=records)
+            if response is None or response.status_code != 200:
+                raise SystemExit("seeding failed: %s" % (response and response.text))
+            scenarios = {}
+            for name in args.scenarios:
+                rng = random.Random("%s:%s" % (args.seed, name))
+                await flush_caches()
+                if name != "cold":
+                    await warm_up(client, catalog)
+                scenarios[name] = await run_operations(client, scenario_operations(name, rng, catalog, args.requests), args.concurrency)
+    finally:
+        await app.app.router.shutdown()
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": database_url.split(":", 1)[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "database_url")},
+        "seed": seed.report(seed.latencies[IMPORT][0])["routes"][IMPORT],
+        "scenarios": scenarios,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the menu API in-process")
+    parser.add_argument("--menus", type=int, default=10)
+    parser.add_argument("--submenus", type=int, default=5, help="per menu")
+    parser.add_argument("--dishes", type=int, default=10, help="per submenu")
+    parser.add_argument("--large-dishes", type=int, default=2000, help="dishes in the large_menu scenario's menu, 0 to skip it")
+    parser.add_argument("--requests", type=int, default=2000, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="e.g. a local postgresql+asyncpg URL; its tables are dropped and recreated")
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+import types
+
+import fakeredis
+import redis.asyncio
+
+
+# one in-memory server, shared by every client the app creates (cache, pub/sub listener)
+server = fakeredis.FakeServer()
+
+
+def use_fake_redis():
+    # the app imports aioredis, whose API redis.asyncio took over; serve it from fakeredis.
+    # Has to run before anything under db/ is imported.
+    module = types.ModuleType("aioredis")
+    module.__dict__.update({name: getattr(redis.asyncio, name) for name in dir(redis.asyncio) if not name.startswith("__")})
+    module.exceptions = sys.modules["redis.exceptions"]
+    module.from_url = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(server=server)
+    sys.modules["aioredis"] = module
+
+
+def use_database(database_url=None):
+    # a throwaway sqlite file unless a database is given; the app drops and recreates its tables on startup
+    if database_url is None:
+        database_url = "sqlite+aiosqlite:///" + os.path.join(tempfile.mkdtemp(prefix="bench"), "bench.db")
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["SCHEMA_MODE"] = "recreate"
+    os.environ["DATABASE_REPLICA_URLS"] = ""
+    return database_url
@@ -0,0 +1,99 @@
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    # gzip only
+    brotli = None
+
+
+class CompressionMiddleware():
+    # Plain ASGI like MetricsMiddleware: brotli or gzip, whichever the client prefers
+    # (brotli on a tie), once the body is at least minimum_size bytes. Streamed bodies
+    # are compressed part by part and flushed, they still arrive as they are written.
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        start = None
+        compress = None
+
+        async def send_wrapper(message):
+            nonlocal start, compress
+            if message["type"] == "http.response.start":
+                # held until the first part of the body shows whether it is worth it
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=list(start["headers"]))
+                if (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith("text/event-stream")
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    await send(start)
+                else:
+                    compress = self.compressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "etag" in headers and not headers["etag"].startswith("W/"):
+                        # the same version, but not the same bytes as the uncompressed one
+                        headers["ETag"] = "W/" + headers["etag"]
+                    del headers["content-length"]
+                    if not more_body:
+                        body = compress(body, False)
+                        headers["Content-Length"] = str(len(body))
+                        await send({**start, "headers": headers.raw})
+                        start = None
+                        return await send({**message, "body": body})
+                    await send({**start, "headers": headers.raw})
+                start = None
+            if compress is not None:
+                message = {**message, "body": compress(body, more_body)}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    def compressor(self, encoding):
+        # compress(data, more) -> bytes, flushed so the client can decode all it has so far
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return lambda data, more: compressor.process(data) + (compressor.flush() if more else compressor.finish())
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return lambda data, more: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH)
+
+
+def choose_encoding(accept_encoding: str):
+    # "br", "gzip" or None from an Accept-Encoding header, q=0 refuses an encoding
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
@@ -1,44 +1,837 @@
+import asyncio
+import functools
 import json
+import logging
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
 
 # from .database import decoded_connection
+import aioredis
+import orjson
 from fastapi.encoders import jsonable_encoder
-from db.config import redis
+from db.config import redis, REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET
+from db.config import CASHE_TTL, CASHE_TTLS, CASHE_COMPRESS_MIN_SIZE, CASHE_COMPRESS_LEVEL
+from db.config import CASHE_STALE_WHILE_REVALIDATE, CASHE_STALE_TTL
+import metrics
+from metrics import CASHE_LATENCY, timed
 
+logger = logging.getLogger(__name__)
 
+# every worker drops its local copies of the keys published here
+INVALIDATE_CHANNEL = "cashe:invalidate"
+LOCAL_MAX_SIZE = 1024
+LOCAL_TTL = 5
+# how long one worker may hold the right to recompute a key
+LOCK_TTL = 5
+LOCK_POLL_INTERVAL = 0.05
+VERSION_TTL = 24 * 60 * 60
+# must outlast the slowest load, see store
+EPOCH_TTL = 10 * 60
+# tags kept while Redis is unavailable, see invalidate
+PENDING_MAX_TAGS = 100_000
+# see write_behind
+WRITE_BEHIND_QUEUE_SIZE = 10_000
+WRITE_BEHIND_WINDOW = 0.005
+WRITE_BEHIND_BATCH_SIZE = 500
+WRITE_BEHIND_RETRIES = 3
+
+
+class LocalCashe():
+    # Bounded LRU/TTL cache of redis values kept in the worker.
+    # Entries are keyed by (redis key, hash field), field is None for plain keys.
+    # It only serves data while the worker listens to INVALIDATE_CHANNEL.
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = False
+        # bumped on every invalidation, a value read from redis before it is not stored
+        self.generation = 0
+        self.data = OrderedDict()
+        self.fields = {}
+
+    def get(self, key, field=None):
+        if not self.enabled:
+            return None
+        item = self.data.get((key, field))
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            self._pop((key, field))
+            return None
+        self.data.move_to_end((key, field))
+        return value
+
+    def set(self, key, value, generation, field=None):
+        if not self.enabled or generation != self.generation:
+            return
+        self.data[(key, field)] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end((key, field))
+        self.fields.setdefault(key, set()).add(field)
+        while len(self.data) > self.max_size:
+            self._pop(next(iter(self.data)))
+
+    def delete(self, *keys):
+        self.generation += 1
+        for key in keys:
+            for field in self.fields.pop(key, ()):
+                self.data.pop((key, field), None)
+
+    def clear(self):
+        self.generation += 1
+        self.data.clear()
+        self.fields.clear()
+
+    def _pop(self, item_key):
+        del self.data[item_key]
+        key, field = item_key
+        fields = self.fields.get(key)
+        if fields is not None:
+            fields.discard(field)
+            if not fields:
+                del self.fields[key]
+
+
+local_cashe = LocalCashe(LOCAL_MAX_SIZE, LOCAL_TTL)
+
+
+class CircuitBreaker():
+    # Closed: Redis is used. max_failures errors in a row open it and the cache is
+    # skipped, reads go to the database. After reset_timeout seconds one call probes
+    # Redis (half-open): the breaker closes if it works and opens again if not.
+
+    def __init__(self, max_failures: int, reset_timeout: float):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # None while closed
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.max_failures:
+            logger.warning("Redis keeps failing, skipping the cache for %ss", self.reset_timeout)
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            self.opened_at = time.monotonic()
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("Redis is back, using the cache again")
+        self.failures = 0
+        self.opened_at = None
+
+    def may_probe(self) -> bool:
+        if self.probing:
+            return False
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.reset_timeout
+
+
+breaker = CircuitBreaker(REDIS_BREAKER_FAILURES, REDIS_BREAKER_RESET)
+# invalidations that could not reach Redis, applied before the cache is used again
+pending_tags = set()
+pending_versions = set()
+
+
+async def cashe_available() -> bool:
+    if breaker.opened_at is None and not pending_tags and not pending_versions:
+        return True
+    if not breaker.may_probe():
+        return False
+    # the probe is the pending invalidations, so nothing they cover is read before
+    breaker.probing = True
+    try:
+        tags, versions = list(pending_tags), list(pending_versions)
+        pending_tags.clear()
+        pending_versions.clear()
+        if tags or versions:
+            await _invalidate(tags, versions)
+        else:
+            await redis.ping()
+    except aioredis.RedisError:
+        remember_invalidation(tags, versions)
+        breaker.failure()
+        return False
+    finally:
+        breaker.probing = False
+    breaker.success()
+    if changes_lost:
+        # the change feed missed the writes made meanwhile
+        await publish_changes([])
+    return True
+
+
+def guarded(fallback):
+    # For the functions that talk to Redis: its errors count against the breaker and
+    # the function returns fallback instead, as it does without calling Redis while the
+    # breaker is open. A callable fallback is called with the function's arguments.
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if await cashe_available():
+                try:
+                    result = await func(*args, **kwargs)
+                except aioredis.RedisError as exc:
+                    logger.debug("Redis error in %s: %r", func.__name__, exc)
+                    metrics.CASHE_ERRORS.labels(metrics.dal_method.get()).inc()
+                    breaker.failure()
+                else:
+                    breaker.success()
+                    return result
+            else:
+                metrics.CASHE_SKIPPED.labels(metrics.dal_method.get()).inc()
+            return fallback(*args, **kwargs) if callable(fallback) else fallback
+        return wrapper
+    return decorator
+
+
+async def listen_invalidations():
+    # keep the local cache coherent with the other workers
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            # messages could be missed while we were not subscribed
+            local_cashe.clear()
+            local_cashe.enabled = True
+            while True:
+                # polled, a blocking read would hit the socket timeout while the channel is quiet
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    local_cashe.delete(*json.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Redis invalidation listener failed, retrying")
+            await asyncio.sleep(1)
+        finally:
+            local_cashe.enabled = False
+            local_cashe.clear()
+            await pubsub.close()
+
+
+def encode(postgres_data):
+    # the cached value is the final response body
+    with timed(CASHE_LATENCY, "encode"):
+        return orjson.dumps(postgres_data, default=encode_default)
+
+
+def encode_loaded(data):
+    # what a loader returned: None, an encoded body or data to encode
+    if data is None or isinstance(data, bytes):
+        return data
+    return encode(data)
+
+
+def encode_default(value):
+    # prices are numeric(10, 2), answered as "10.20" like the response models do
+    if isinstance(value, Decimal):
+        return str(value)
+    return jsonable_encoder(value)
+
+
+# Values are stored as CODEC_MARK, the id of the codec that wrote them, then its output.
+# Values without the mark are plain JSON written before codecs existed, read as they are.
+# The local cache keeps the decoded bodies.
+CODEC_MARK = b"\x00"
+
+
+class PlainCodec():
+    id = b"\x01"
+
+    def encode(self, body: bytes) -> bytes:
+        return body
+
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCodec():
+    id = b"\x02"
+
+    def __init__(self, level: int):
+        self.level = level
+
+    def encode(self, body: bytes) -> bytes:
+        return zlib.compress(body, self.level)
+
+    def decode(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+# by id; a new codec gets a new id, the old ones stay to read what they wrote
+codecs = {codec.id: codec for codec in (PlainCodec(), ZlibCodec(CASHE_COMPRESS_LEVEL))}
+plain_codec = codecs[PlainCodec.id]
+compress_codec = codecs[ZlibCodec.id]
+
+
+def pack(body: bytes) -> bytes:
+    codec = compress_codec if len(body) >= CASHE_COMPRESS_MIN_SIZE else plain_codec
+    with timed(CASHE_LATENCY, "pack"):
+        return CODEC_MARK + codec.id + codec.encode(body)
+
+
+def unpack(value: bytes) -> bytes | None:
+    # None for a codec this worker doesn't know, written by a newer one: a miss
+    if not value.startswith(CODEC_MARK):
+        return value
+    codec = codecs.get(value[1:2])
+    if codec is None:
+        return None
+    with timed(CASHE_LATENCY, "unpack"):
+        return codec.decode(value[2:])
+
+
+# the prefixes of the keys BookDAL caches under, longer ones first: ids are uuids,
+# so "dish" + id can't be taken for "dishes"
+KEY_FAMILIES = ("submenus", "submenu", "dishes", "dish", "menus", "menu", "tree")
+if set(CASHE_TTLS) - set(KEY_FAMILIES):
+    raise ValueError("CASHE_TTLS has unknown key families: %s" % ", ".join(sorted(set(CASHE_TTLS) - set(KEY_FAMILIES))))
+
+
+def key_ttl(key_redis):
+    # the TTL of the key's family, see CASHE_TTLS in db/config.py
+    for family in KEY_FAMILIES:
+        if key_redis.startswith(family):
+            return CASHE_TTLS.get(family, CASHE_TTL)
+    return CASHE_TTL
+
+
+def encode_page(items, next_cursor):
+    # "<next cursor>\n<json list>"
+    return (next_cursor or "").encode() + b"\n" + encode(items)
+
+
+def decode_page(rescash):
+    next_cursor, _, body = rescash.partition(b"\n")
+    return body, next_cursor.decode() or None
+
+
+@guarded(None)
 async def get_cash(key_redis):
-    redis_data = await redis.get(key_redis)
+    local_data = local_cashe.get(key_redis)
+    if local_data is not None:
+        count_lookup("local_hit")
+        return local_data
+    generation = local_cashe.generation
+    with timed(CASHE_LATENCY, "get"):
+        redis_data = await redis.get(key_redis)
     if redis_data:
-        return json.loads(redis_data)
+        metrics.CASHE_READ_BYTES.labels(metrics.dal_method.get()).inc(len(redis_data))
+        redis_data = unpack(redis_data)
+    if redis_data:
+        count_lookup("hit")
+        local_cashe.set(key_redis, redis_data, generation)
+        return redis_data
+    count_lookup("miss")
     return None
 
 
-async def set_cash(postgres_data, key_redis):
-    # encode object to json, then json to str
-    rescash = json.dumps(jsonable_encoder(postgres_data))
+def count_lookup(result):
+    metrics.CASHE_LOOKUPS.labels(metrics.dal_method.get(), result).inc()
+
+
+async def set_cash(rescash, key_redis, tags=(), epochs=None):
     # set to redis
-    await redis.set(key_redis, rescash, 60)
+    await store(rescash, key_redis, "", tags, epochs)
+
+
+def submenus_key(menu_id):
+    return "submenus" + menu_id
+
+
+def dishes_key(submenu_id):
+    return "dishes" + submenu_id
+
+
+def page_field(cursor, limit):
+    # every page of one parent lives in one hash, so a write drops all of them at once
+    return "%s:%s" % (cursor or "", limit)
+
+
+@guarded(None)
+async def get_page_cash(key_redis, field):
+    local_data = local_cashe.get(key_redis, field)
+    if local_data is not None:
+        count_lookup("local_hit")
+        return local_data
+    generation = local_cashe.generation
+    with timed(CASHE_LATENCY, "get"):
+        redis_data = await redis.hget(key_redis, field)
+    if redis_data:
+        metrics.CASHE_READ_BYTES.labels(metrics.dal_method.get()).inc(len(redis_data))
+        redis_data = unpack(redis_data)
+    if redis_data:
+        count_lookup("hit")
+        local_cashe.set(key_redis, redis_data, generation, field)
+        return redis_data
+    count_lookup("miss")
+    return None
+
+
+def tag_key(tag):
+    return "tag:" + tag
+
+
+def epoch_key(tag):
+    # bumped each time the tag is invalidated
+    return "epoch:" + tag
+
+
+# Write the value and register it in its tag sets ("menu:<id>", "dishes:<submenu_id>", ...),
+# its stale copy too: that only stands in for a value that has expired, never for one a
+# write has invalidated, which would go out with the version the write has bumped.
+# A tag set lives as long as the key in it that expires last. With epochs, nothing is written
+# if one of the tags has been invalidated since they were read: the value was
+# loaded before that write and would stay in the cache after it.
+# KEYS: key, stale key, tag sets, epoch keys.
+# ARGV: value, hash field or "", ttl, stale ttl or 0, number of tag sets, epochs.
+store_script = redis.register_script("""
+local tags_count = tonumber(ARGV[5])
+for i = 3 + tags_count, #KEYS do
+    if (redis.call("get", KEYS[i]) or "") ~= ARGV[3 + i - tags_count] then
+        return 0
+    end
+end
+if ARGV[2] == "" then
+    redis.call("set", KEYS[1], ARGV[1], "EX", ARGV[3])
+    if ARGV[4] ~= "0" then
+        redis.call("set", KEYS[2], ARGV[1], "EX", ARGV[4])
+    end
+else
+    redis.call("hset", KEYS[1], ARGV[2], ARGV[1])
+    redis.call("expire", KEYS[1], ARGV[3])
+    if ARGV[4] ~= "0" then
+        redis.call("hset", KEYS[2], ARGV[2], ARGV[1])
+        redis.call("expire", KEYS[2], ARGV[4])
+    end
+end
+local ttl = math.max(tonumber(ARGV[3]), tonumber(ARGV[4]))
+for i = 3, 2 + tags_count do
+    redis.call("sadd", KEYS[i], KEYS[1])
+    if ARGV[4] ~= "0" then
+        redis.call("sadd", KEYS[i], KEYS[2])
+    end
+    if redis.call("ttl", KEYS[i]) < ttl then
+        redis.call("expire", KEYS[i], ttl)
+    end
+end
+return 1
+""")
+
+
+@guarded(None)
+async def store(rescash, key_redis, field, tags, epochs=None):
+    epochs = epochs or {}
+    value = pack(rescash)
+    metrics.CASHE_STORED_BYTES.labels(metrics.dal_method.get()).inc(len(value))
+    with timed(CASHE_LATENCY, "set"):
+        stored = await store_script(
+            keys=[key_redis, stale_key(key_redis)] + [tag_key(tag) for tag in tags] + [epoch_key(tag) for tag in epochs],
+            args=[value, field, key_ttl(key_redis), CASHE_STALE_TTL if CASHE_STALE_WHILE_REVALIDATE else 0, len(tags)]
+            + list(epochs.values()),
+        )
+    metrics.CASHE_SETS.labels(metrics.dal_method.get(), "stored" if stored else "fenced").inc()
+
+
+@guarded(lambda tags: {})
+async def get_epochs(tags):
+    if not tags:
+        return {}
+    epochs = await redis.mget([epoch_key(tag) for tag in tags])
+    return {tag: epoch or b"" for tag, epoch in zip(tags, epochs)}
+
+
+def stale_key(key_redis):
+    # last known value, kept after key_redis expires, dropped with it by invalidations
+    return "stale:" + key_redis
+
+
+def lock_key(key_redis, field=None):
+    if field is None:
+        return "lock:" + key_redis
+    return "lock:%s:%s" % (key_redis, field)
+
+
+# compare-and-delete, so a worker never frees a lock that expired and was taken by another
+release_lock = redis.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+""")
+
+# misses being loaded in this worker, (key, field) -> future with the loaded value
+inflight = {}
+# set on a future when its loader failed, waiters then load by themselves
+LOAD_FAILED = object()
+
+
+async def get_or_set(key_redis, load, field=None, tags=(), data_tags=None):
+    # Return the cached body or call load() and cache its encoded result under tags,
+    # plus data_tags(loaded value) for tags only known after loading.
+    # Only one request per worker and, through a redis lock, one worker
+    # at a time runs load() for the same key; the others wait for its result.
+    redis_data = await _get(key_redis, field)
+    if redis_data is not None:
+        return redis_data
+    flight_key = (key_redis, field)
+    future = inflight.get(flight_key)
+    if future is not None:
+        if CASHE_STALE_WHILE_REVALIDATE:
+            stale_data = await _get_stale(key_redis, field)
+            if stale_data is not None:
+                return stale_data
+        data = await asyncio.shield(future)
+        if data is not LOAD_FAILED:
+            return data
+        return await _load_and_set(key_redis, field, load, tags, data_tags)
+    future = asyncio.get_running_loop().create_future()
+    inflight[flight_key] = future
+    try:
+        data = await _load_locked(key_redis, field, load, tags, data_tags)
+    except BaseException:
+        future.set_result(LOAD_FAILED)
+        raise
+    else:
+        future.set_result(data)
+        return data
+    finally:
+        del inflight[flight_key]
+
+
+async def _load_locked(key_redis, field, load, tags, data_tags):
+    token = uuid.uuid4().hex
+    lock = lock_key(key_redis, field)
+    if not await take_lock(lock, token):
+        # another worker is loading this key
+        if CASHE_STALE_WHILE_REVALIDATE:
+            stale_data = await _get_stale(key_redis, field)
+            if stale_data is not None:
+                return stale_data
+        deadline = time.monotonic() + LOCK_TTL
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            redis_data = await _get(key_redis, field)
+            if redis_data is not None:
+                return redis_data
+            if not await lock_held(lock):
+                break
+        # the other worker failed or is too slow, load without the lock
+        return await _load_and_set(key_redis, field, load, tags, data_tags)
+    try:
+        return await _load_and_set(key_redis, field, load, tags, data_tags)
+    finally:
+        await free_lock(lock, token)
+
+
+@guarded(True)
+async def take_lock(lock, token):
+    # also "taken" while Redis is unavailable, the caller then loads by itself
+    return await redis.set(lock, token, nx=True, px=int(LOCK_TTL * 1000))
+
+
+@guarded(False)
+async def lock_held(lock):
+    return await redis.exists(lock)
+
+
+@guarded(None)
+async def free_lock(lock, token):
+    await release_lock(keys=[lock], args=[token])
+
+
+async def _load_and_set(key_redis, field, load, tags, data_tags):
+    epochs = await get_epochs(tags)
+    data = await load()
+    # None means "not found" and is not cached
+    if data is None:
+        return None
+    rescash = encode_loaded(data)
+    if data_tags is not None:
+        tags = list(tags) + data_tags(data)
+    await store(rescash, key_redis, field or "", tags, epochs)
+    return rescash
+
+
+async def _get(key_redis, field):
+    if field is None:
+        return await get_cash(key_redis)
+    return await get_page_cash(key_redis, field)
+
+
+@guarded(None)
+async def _get_stale(key_redis, field):
+    if field is None:
+        redis_data = await redis.get(stale_key(key_redis))
+    else:
+        redis_data = await redis.hget(stale_key(key_redis), field)
+    return unpack(redis_data) if redis_data else None
+
+
+# Drop every key registered under the given tag sets, and the sets themselves, bump
+# the tags' epochs, bump the versions and tell the other workers which keys and
+# versions changed, all in one round trip. Returns the dropped keys and the new epochs.
+# KEYS: tag sets, epoch keys of the same tags, version keys.
+# ARGV: channel, number of tags, initial version, version ttl, epoch ttl.
+invalidate_tags = redis.register_script("""
+local tags_count = tonumber(ARGV[2])
+local keys = {}
+local epochs = {}
+for i = 1, tags_count do
+    for _, key in ipairs(redis.call("smembers", KEYS[i])) do
+        keys[#keys + 1] = key
+    end
+    epochs[i] = tostring(redis.call("incr", KEYS[tags_count + i]))
+    redis.call("expire", KEYS[tags_count + i], ARGV[5])
+end
+if tags_count > 0 then
+    redis.call("del", unpack(KEYS, 1, tags_count))
+end
+for i = 1, #keys, 1000 do
+    redis.call("del", unpack(keys, i, math.min(i + 999, #keys)))
+end
+local published = {}
+for i = 2 * tags_count + 1, #KEYS do
+    redis.call("set", KEYS[i], ARGV[3], "NX", "EX", ARGV[4])
+    redis.call("incr", KEYS[i])
+    published[#published + 1] = KEYS[i]
+end
+for _, key in ipairs(keys) do
+    published[#published + 1] = key
+end
+if #published > 0 then
+    redis.call("publish", ARGV[1], cjson.encode(published))
+end
+return {keys, epochs}
+""")
+
+
+async def invalidate(*tags, versions=()):
+    # Returns the new epoch of every tag, to write fresh values straight back with store.
+    # While Redis is unavailable the tags and versions are kept for later and {} is
+    # returned: the cache is not read again until they have been invalidated.
+    if not tags and not versions:
+        return {}
+    tags, versions = list(set(tags)), list(set(versions))
+    if not await cashe_available():
+        remember_invalidation(tags, versions)
+        return {}
+    try:
+        epochs = await _invalidate(tags, versions)
+    except aioredis.RedisError:
+        metrics.CASHE_ERRORS.labels(metrics.dal_method.get()).inc()
+        remember_invalidation(tags, versions)
+        breaker.failure()
+        return {}
+    breaker.success()
+    return epochs
+
+
+def remember_invalidation(tags, versions):
+    pending_versions.update(versions)
+    if len(pending_tags) + len(tags) > PENDING_MAX_TAGS:
+        logger.error("too many cache invalidations while Redis is unavailable, entries may be stale until they expire")
+        return
+    pending_tags.update(tags)
+
+
+async def _invalidate(tags, versions):
+    with timed(CASHE_LATENCY, "invalidate"):
+        keys, epochs = await invalidate_tags(
+            keys=[tag_key(tag) for tag in tags] + [epoch_key(tag) for tag in tags]
+            + [version_key(name) for name in versions],
+            args=[INVALIDATE_CHANNEL, len(tags), initial_version(), VERSION_TTL, EPOCH_TTL],
+        )
+    local_cashe.delete(*[key.decode() for key in keys], *[version_key(name) for name in versions])
+    metrics.CASHE_DELETES.labels(metrics.dal_method.get()).inc(len(keys))
+    return dict(zip(tags, epochs))
+
+
+# Write-behind, with CASHE_WRITE_BEHIND: writes queue their cache work for run_write_behind
+# instead of waiting for Redis, so they answer as soon as the database has committed: the
+# invalidation of their tags and versions, the write-through of the value they returned
+# and their change feed events. Until the worker gets to a job, a few milliseconds
+# normally, reads may still get the old values and ETags, also the writer's own reads.
+# Without it the same jobs run inline, before the response.
+write_behind_queue = None
+
+
+async def invalidate_later(tags, versions=(), refresh=None, changes=()):
+    # refresh is (key, body, tags, known): a value to write through once the tags are
+    # invalidated, under the epochs that returns, or under known, read before the write,
+    # for the tags it doesn't invalidate. changes are published after that, see publish_changes.
+    # Runs inline when the queue is full or no worker is running (scripts, tests).
+    job = (tags, versions, refresh, changes)
+    if write_behind_queue is not None:
+        try:
+            write_behind_queue.put_nowait(job)
+        except asyncio.QueueFull:
+            pass
+        else:
+            metrics.CASHE_WRITE_BEHIND.labels("queued").inc()
+            return
+    metrics.CASHE_WRITE_BEHIND.labels("inline").inc()
+    await apply_jobs([job])
+
+
+async def apply_jobs(jobs):
+    # Every tag and version once for the whole batch, then the write-throughs, then the
+    # changes: a client refetching on an event doesn't get the old entry.
+    tags, versions, refreshes = set(), set(), {}
+    for job_tags, job_versions, refresh, _ in jobs:
+        tags.update(job_tags)
+        versions.update(job_versions)
+        if refresh is not None:
+            # two writes of one key: which body is newer isn't known, a read loads it
+            refreshes[refresh[0]] = None if refresh[0] in refreshes else refresh
+    epochs = await invalidate(*tags, versions=versions)
+    await asyncio.gather(*[
+        set_cash(body, key, refresh_tags, {tag: known.get(tag, epochs.get(tag, b"")) for tag in refresh_tags})
+        for key, body, refresh_tags, known in filter(None, refreshes.values())
+    ])
+    await publish_changes([change for *_, changes in jobs for change in changes])
+
+
+async def run_write_behind():
+    # Started with the app. Jobs arriving within WRITE_BEHIND_WINDOW of each other
+    # are applied together; a batch that keeps failing is dropped, its entries stay
+    # stale until they expire, after CASHE_TTL at most, and its events are lost.
+    global write_behind_queue
+    queue = write_behind_queue = asyncio.Queue(WRITE_BEHIND_QUEUE_SIZE)
+    metrics.dal_method.set("write_behind")
+    try:
+        while True:
+            jobs = [await queue.get()]
+            await asyncio.sleep(WRITE_BEHIND_WINDOW)
+            while len(jobs) < WRITE_BEHIND_BATCH_SIZE and not queue.empty():
+                jobs.append(queue.get_nowait())
+            metrics.CASHE_WRITE_BEHIND_BATCH.observe(len(jobs))
+            try:
+                for attempt in range(WRITE_BEHIND_RETRIES):
+                    try:
+                        await apply_jobs(jobs)
+                        break
+                    except Exception:
+                        if attempt == WRITE_BEHIND_RETRIES - 1:
+                            logger.exception("dropping %s write-behind jobs", len(jobs))
+                            metrics.CASHE_WRITE_BEHIND.labels("failed").inc(len(jobs))
+                        else:
+                            await asyncio.sleep(0.1 * 2 ** attempt)
+            finally:
+                for _ in jobs:
+                    queue.task_done()
+    finally:
+        write_behind_queue = None
+
+
+async def drain_write_behind(timeout: float):
+    # at shutdown, before the worker is cancelled
+    if write_behind_queue is None:
+        return
+    try:
+        await asyncio.wait_for(write_behind_queue.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("%s write-behind jobs left in the queue", write_behind_queue.qsize())
+
+
+# Change feed: writes append their events to CHANGES_STREAM, whose entry ids are the
+# sequence clients resume from, and publish them on CHANGES_CHANNEL for every worker to
+# push to its subscribers, see db/cashe/changes.py. Events are dicts with "op" (create,
+# update, delete or reload), "kind", "menu_id" and the fields of the row.
+CHANGES_STREAM = "changes"
+# id of the newest entry trimmed from the stream, resuming from before it is impossible
+CHANGES_TRIMMED = "changes:trimmed"
+CHANGES_CHANNEL = "cashe:changes"
+CHANGES_MAX_LEN = 10_000
+# tells subscribers to load everything again, after changes were lost or too many to list
+RELOAD = {"op": "reload"}
+changes_lost = False
+
+# KEYS: stream, trimmed mark. ARGV: channel, max length, then menu id and event of each change.
+publish_events = redis.register_script("""
+local published = {}
+for i = 3, #ARGV, 2 do
+    local id = redis.call("xadd", KEYS[1], "*", "menu_id", ARGV[i], "event", ARGV[i + 1])
+    published[#published + 1] = {id, ARGV[i], ARGV[i + 1]}
+end
+local extra = redis.call("xlen", KEYS[1]) - tonumber(ARGV[2])
+if extra > 0 then
+    local trimmed = redis.call("xrange", KEYS[1], "-", "+", "COUNT", extra)
+    redis.call("set", KEYS[2], trimmed[#trimmed][1])
+    redis.call("xtrim", KEYS[1], "MAXLEN", ARGV[2])
+end
+redis.call("publish", ARGV[1], cjson.encode(published))
+return #published
+""")
+
+
+def lose_changes(changes):
+    global changes_lost
+    changes_lost = changes_lost or bool(changes)
+
+
+@guarded(lose_changes)
+async def publish_changes(changes):
+    # Changes that can't be published are lost; the next ones published start with a
+    # reload, so subscribers don't go on with data that has missed them.
+    global changes_lost
+    if not changes and not changes_lost:
+        return
+    if changes_lost:
+        changes = [RELOAD] + changes
+    args = [CHANGES_CHANNEL, CHANGES_MAX_LEN]
+    for change in changes:
+        args += [change.get("menu_id", ""), encode(change)]
+    with timed(CASHE_LATENCY, "publish"):
+        await publish_events(keys=[CHANGES_STREAM, CHANGES_TRIMMED], args=args)
+    changes_lost = False
 
 
-async def del_cashe(key_redis):
-    await redis.delete(key_redis)
+def version_key(name):
+    return "version:" + name
 
 
-async def change_dish_cashe(menu_id, submenu_id, dish_id=""):
-    await del_cashe("dishes")
-    await del_cashe("menus")
-    await del_cashe("submenus")
-    await del_cashe("menu" + menu_id)
-    await del_cashe("submenu" + submenu_id)
-    await del_cashe("dish" + dish_id)
+def initial_version():
+    # A lost or expired version restarts from the clock, in microseconds,
+    # so it never goes back to a value a client may still hold in an ETag
+    return time.time_ns() // 1000
 
 
-async def change_submenu_cashe(menu_id="", submenu_id=""):
-    await del_cashe("menus")
-    await del_cashe("submenus")
-    await del_cashe("menu" + menu_id)
-    await del_cashe("submenu" + submenu_id)
+@guarded(lambda *names: [None] * len(names))
+async def get_versions(*names):
+    # Current version of each name, None for one that has none yet and for every name
+    # while Redis is unavailable. Only writes and create_version make versions, GETs of
+    # ids that don't exist leave nothing in Redis. Versions are kept in the local cache
+    # too, invalidate_tags publishes the ones it bumps.
+    keys = [version_key(name) for name in names]
+    versions = [local_cashe.get(key) for key in keys]
+    missing = [key for key, version in zip(keys, versions) if version is None]
+    if not missing:
+        return versions
+    generation = local_cashe.generation
+    with timed(CASHE_LATENCY, "versions"):
+        res = await redis.mget(missing)
+    found = {key: int(version) for key, version in zip(missing, res) if version is not None}
+    for key, version in found.items():
+        local_cashe.set(key, version, generation)
+    return [found.get(key, version) for key, version in zip(keys, versions)]
 
 
-async def change_menu_cashe(menu_id=""):
-    await del_cashe("menus")
-    await del_cashe("menu" + menu_id)
+@guarded(None)
+async def create_version(name):
+    # A first version for something a read has just found. None if there is one already:
+    # a write may have made it after the body was read, which would then go out with a
+    # version newer than what it shows.
+    key = version_key(name)
+    version = initial_version()
+    generation = local_cashe.generation
+    with timed(CASHE_LATENCY, "versions"):
+        if not await redis.set(key, version, nx=True, ex=VERSION_TTL):
+            return None
+    local_cashe.set(key, version, generation)
+    return version
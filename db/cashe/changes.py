@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+
+from db.config import redis
+from db.cashe import cashe
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# events waiting for one client; past that it catches up from the stream instead
+SUBSCRIPTION_QUEUE_SIZE = 1000
+# entries per read of the stream when a client catches up
+CATCH_UP_PAGE_SIZE = 1000
+# seconds between comments sent on a quiet feed, so proxies keep the connection open
+KEEPALIVE_INTERVAL = 15
+# milliseconds clients wait before they reconnect
+RECONNECT_DELAY = 3000
+
+
+class Subscription():
+    # One client of this worker, fed by listen_changes. When its queue overflows, or the
+    # listener has to subscribe again and may have missed messages, it is marked behind:
+    # the queue is dropped and the missing events are read from the stream.
+    def __init__(self, menu_id=None):
+        self.menu_id = menu_id
+        self.queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE)
+        self.behind = False
+        self.closed = False
+
+    def put(self, entry):
+        # entry is (stream id, menu id, event), None only wakes the reader
+        if entry is not None and self.menu_id and entry[1] and entry[1] != self.menu_id:
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.behind = True
+
+    def fall_behind(self):
+        self.behind = True
+        self.put(None)
+
+    def close(self):
+        self.closed = True
+        self.put(None)
+
+    def matches(self, menu_id):
+        return not self.menu_id or not menu_id or menu_id == self.menu_id
+
+
+subscriptions = set()
+# set when the worker shuts down, see close_subscriptions
+closing = False
+
+
+def close_subscriptions():
+    # Feeds never end by themselves, the worker would wait for them forever when it
+    # drains its connections. Their clients reconnect to another worker and resume.
+    global closing
+    closing = True
+    for subscription in subscriptions:
+        subscription.close()
+
+
+async def listen_changes():
+    # started with the app, fans the changes published by every worker out to this one's clients
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(cashe.CHANGES_CHANNEL)
+            for subscription in subscriptions:
+                subscription.fall_behind()
+            while True:
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    for entry in json.loads(message["data"]):
+                        for subscription in subscriptions:
+                            subscription.put(entry)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Redis change listener failed, retrying")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
+
+
+def parse_id(value):
+    # stream ids are "<milliseconds>-<sequence>", compared as numbers; None if malformed
+    if isinstance(value, bytes):
+        value = value.decode()
+    milliseconds, _, sequence = str(value).partition("-")
+    try:
+        return int(milliseconds), int(sequence or 0)
+    except ValueError:
+        return None
+
+
+def format_id(stream_id):
+    return "%s-%s" % stream_id
+
+
+async def last_id():
+    entries = await redis.xrevrange(cashe.CHANGES_STREAM, count=1)
+    return parse_id(entries[0][0]) if entries else (0, 0)
+
+
+async def read_after(after):
+    # The entries newer than after as (stream id, menu id, event), or None when some
+    # of them have been trimmed from the stream or it has been lost.
+    if after > await last_id():
+        return None
+    entries = []
+    while True:
+        page = await redis.xrange(cashe.CHANGES_STREAM, min=format_id(after), count=CATCH_UP_PAGE_SIZE)
+        # checked after the read, an entry trimmed before it could be missing from the page
+        trimmed = await redis.get(cashe.CHANGES_TRIMMED)
+        if trimmed is not None and parse_id(trimmed) > after:
+            return None
+        for stream_id, fields in page:
+            stream_id = parse_id(stream_id)
+            if stream_id > after:
+                entries.append((stream_id, fields[b"menu_id"].decode(), fields[b"event"].decode()))
+                after = stream_id
+        if len(page) < CATCH_UP_PAGE_SIZE:
+            return entries
+
+
+def sse(event: str, stream_id=None, data: str = "{}") -> bytes:
+    lines = ["event: " + event]
+    if stream_id is not None:
+        lines.append("id: " + format_id(stream_id))
+    lines.append("data: " + data)
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+async def stream_changes(menu_id=None, since=None):
+    # Server-Sent Events, each change as a "change" event whose id is its place in the
+    # stream. Without since the feed starts with "ready", with since it starts with the
+    # changes after it, or with "reset" if they are no longer all kept. After ready or
+    # reset the client loads what it shows, then applies the changes that follow.
+    if closing:
+        return
+    subscription = Subscription(menu_id)
+    subscriptions.add(subscription)
+    metrics.CHANGES_SUBSCRIBERS.inc()
+    try:
+        yield ("retry: %s\n\n" % RECONNECT_DELAY).encode()
+        last = None if since is None else parse_id(since)
+        if last is None:
+            last = await last_id()
+            yield sse("ready" if since is None else "reset", last)
+        else:
+            subscription.behind = True
+        while not subscription.closed:
+            if subscription.behind:
+                subscription.behind = False
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                entries = await read_after(last)
+                if entries is None:
+                    metrics.CHANGES_CATCH_UPS.labels("reset").inc()
+                    last = await last_id()
+                    yield sse("reset", last)
+                    continue
+                metrics.CHANGES_CATCH_UPS.labels("resumed").inc()
+                for stream_id, entry_menu_id, event in entries:
+                    last = stream_id
+                    if subscription.matches(entry_menu_id):
+                        yield sse("change", stream_id, event)
+                continue
+            try:
+                entry = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if entry is None:
+                continue
+            stream_id = parse_id(entry[0])
+            # already sent when the client caught up
+            if stream_id > last:
+                last = stream_id
+                yield sse("change", stream_id, entry[2])
+    finally:
+        subscriptions.discard(subscription)
+        metrics.CHANGES_SUBSCRIBERS.dec()
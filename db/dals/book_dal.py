@@ -1,20 +1,61 @@
+import asyncio
+import re
+from collections import Counter
 from typing import List, Optional
-from fastapi.encoders import jsonable_encoder
+import orjson
 from fastapi import HTTPException
 
-from sqlalchemy import update, delete
+from sqlalchemy import String, insert, update, delete, func, cast, literal_column, null, table, union_all, Text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
-from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.orm import Session
 
-from db.models.book import Book, Menu, Submenu, Dish
+from db.models.book import Book, Menu, Submenu, Dish, generate_uuid, search_vector
 from db.models import schemas
-from db.config import redis
+from db.config import redis, async_session
 from db.cashe import cashe
+import metrics
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# rows per import transaction and per cache invalidation
+IMPORT_BATCH_SIZE = 1000
+# rows per fetch from a server-side cursor, for the export and streamed lists
+EXPORT_CHUNK_SIZE = 1000
+SEARCH_KINDS = ("menu", "submenu", "dish")
+SEARCH_MAX_WORDS = 10
 
+
+@metrics.instrument_dal
 class BookDAL():
-    def __init__(self, db_session: Session):
+    # Cached entries are tagged with what they show and writes invalidate those tags:
+    #   "menus"                  the menu list
+    #   "menu:<id>"              one menu with its counts
+    #   "submenus:<menu_id>"     submenu pages of a menu
+    #   "submenu:<id>"           one submenu with its dish count
+    #   "dishes:<submenu_id>"    dish pages of a submenu
+    #   "dish:<id>"              one dish
+    #   "subtree:<submenu_id>"   everything under a submenu, dropped when it is deleted
+    # Whatever is cached is loaded from db_session, on the primary: a lagging replica would
+    # cache rows older than the epochs and versions the last write left, and clients would
+    # keep them until the next write. replica_session serves the reads that are never cached.
+    def __init__(self, db_session: Session, replica_session: Optional[Session] = None):
         self.db_session = db_session
+        self.replica_session = replica_session or db_session
+
+    async def commit(self, *tags, versions=(), refresh=None, changes=()):
+        # Commit before touching the cache, otherwise a concurrent read could cache
+        # the old rows again or pin them to the new version.
+        # versions are bumped for conditional GETs: "menus" when the menu list changes,
+        # "menu:<id>" on any write in that menu.
+        # refresh is (key, body, tags, epochs): the row the write has just returned, cached
+        # under the epochs the invalidation leaves on its tags. If another write has
+        # invalidated one of them since, nothing is stored.
+        # changes are the events of the change feed, see change below.
+        # With CASHE_WRITE_BEHIND all this runs after the response, see cashe.invalidate_later.
+        await self.db_session.commit()
+        await cashe.invalidate_later(tags, versions, refresh, changes)
 
     # async def create_book(self, name: str, author: str,   release_year: int):
     #     new_book = Book(name=name,author=author, release_year=release_year)
@@ -37,36 +78,38 @@ class BookDAL():
     #     await  self.db_session.execute(q)
 
 
-    async def get_menus(self) -> List[Menu]:
-        # Get data from redis
-        redis_data = await cashe.get_cash("menus")
-        if redis_data:
-            return redis_data
-        else:
-            # Get data from postgres
-            q = await self.db_session.execute(select(Menu).options(selectinload(Menu.submenus).options(selectinload(Submenu.dishes))))
-            my_db = q.scalars().all()
-            if my_db:
-                res = []
-                for instance in my_db:
-                    menu_dict = jsonable_encoder(instance)
-                    menu_dict["submenus_count"] = (len(instance.submenus))
-                    dishes = 0
-                    for d in instance.submenus:
-                        dishes += len(d.dishes)
-                    menu_dict["dishes_count"] = dishes
-                    res.append(menu_dict)
-                await cashe.set_cash(res, "menus")
-                return res
-            await cashe.set_cash(my_db, "menus")
-            return my_db
-    
+    def menus_query(self):
+        return select(Menu.title, Menu.description, Menu.id, Menu.submenus_count, Menu.dishes_count)
+
+    async def get_menus(self) -> bytes:
+        return await cashe.get_or_set("menus", self.load_menus, tags=["menus"])
+
+    async def load_menus(self) -> List[dict]:
+        # Get data from postgres
+        q = await self.db_session.execute(self.menus_query().order_by(Menu.id))
+        return [row._asdict() for row in q]
+
+    async def stream_menus(self):
+        async for chunk in self.stream_list(self.menus_query().order_by(Menu.id)):
+            yield chunk
+
+    async def stream_list(self, q):
+        # The rows of q as one JSON array, written as they come from a server-side
+        # cursor: memory stays flat however long the list is. Not cached.
+        result = await self.replica_session.stream(q.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        separator = b"["
+        async for rows in result.partitions():
+            yield separator + cashe.encode([row._asdict() for row in rows])[1:-1]
+            separator = b","
+        yield b"]" if separator == b"," else b"[]"
+
     async def create_menu(self, menu: schemas.MenuCreate):
         new_menu = Menu(title=menu.title, description=menu.description)
         self.db_session.add(new_menu)
         await self.db_session.flush()
-        await cashe.del_cashe("menus")
-        await cashe.change_menu_cashe()
+        await self.commit("menus", versions=["menus"], changes=[change(
+            "create", "menu", new_menu.id, id=new_menu.id, title=new_menu.title, description=new_menu.description,
+        )])
         return new_menu
 
     async def get_menu_by_title(self, title: str):
@@ -76,158 +119,716 @@ class BookDAL():
         if q:
             raise HTTPException(status_code=400, detail="Menu already exist")
         
-    async def get_menu(self, menu_id: str):
-    # Get data from redis
-        redis_data = await cashe.get_cash("menu" + menu_id)
-        if redis_data:
-            return redis_data
-        else:
-        #     Get data from postgres
-            my_db = await self.db_session.execute(select(Menu).where(Menu.id == menu_id).options(selectinload(Menu.submenus).options(selectinload(Submenu.dishes))))
-            my_db = my_db.scalars().all()
-            if my_db:
-                res = jsonable_encoder(my_db)
-                res[0]["submenus_count"] = len(res[0]["submenus"])
-                dishes = 0
-                for d in res[0]["submenus"]:
-                    dishes += len(d["dishes"])
-                res[0]["dishes_count"] = dishes
-                del res[0]["submenus"]
-                # Set data to redis
-                await cashe.set_cash(res, "menu" + menu_id)
-                return res[0]
-            # Set data to redis
-            await cashe.set_cash(my_db, "menu" + menu_id)
-            return my_db
-
-    async def update_menu(self, menu: schemas.MenuBase, api_test_menu_id):
-        q = update(Menu).where(Menu.id == api_test_menu_id)
-        q = q.values(title=menu.title)
-        q = q.values(description=menu.description)
-        q.execution_options(synchronize_session="fetch")
-        await self.db_session.execute(q)
-        await cashe.change_menu_cashe(api_test_menu_id)
-        db_menu = await self.get_menu(menu_id=api_test_menu_id)
-        await cashe.change_menu_cashe(api_test_menu_id)
+    async def get_menu(self, menu_id: str) -> Optional[bytes]:
+        return await cashe.get_or_set("menu" + menu_id, lambda: self.load_menu(menu_id), tags=["menu:" + menu_id])
+
+    async def load_menu(self, menu_id: str) -> Optional[dict]:
+        # Get data from postgres
+        q = await self.db_session.execute(self.menus_query().where(Menu.id == menu_id))
+        row = q.first()
+        if row is None:
+            return None
+        return row._asdict()
+
+    async def update_menu(self, menu: schemas.MenuBase, api_test_menu_id) -> Optional[bytes]:
+        # One statement checks the menu exists, updates it and returns the response,
+        # which goes straight to the cache. None if there is no such menu.
+        q = (
+            update(Menu).where(Menu.id == api_test_menu_id)
+            .values(title=menu.title, description=menu.description)
+            .returning(*self.menus_query().selected_columns)
+            .execution_options(synchronize_session=False)
+        )
+        row = (await self.db_session.execute(q)).first()
+        if row is None:
+            return None
+        db_menu = cashe.encode(row._asdict())
+        await self.commit(
+            "menus", "menu:" + api_test_menu_id, versions=["menus", "menu:" + api_test_menu_id],
+            refresh=("menu" + api_test_menu_id, db_menu, ["menu:" + api_test_menu_id], {}),
+            changes=[change("update", "menu", api_test_menu_id, **row._asdict())],
+        )
         return db_menu
 
-    async def delete_menu(self, menu_id: str):
-        q = delete(Menu).where(Menu.id == menu_id)
-        res = await self.db_session.execute(q)
+    async def delete_menu(self, menu_id: str) -> Optional[dict]:
+        # the database cascades to these, their cached entries have to go too
+        submenu_ids = (await self.db_session.scalars(select(Submenu.id).where(Submenu.main_menu_id == menu_id))).all()
+        q = delete(Menu).where(Menu.id == menu_id).returning(Menu.id)
+        if (await self.db_session.execute(q)).first() is None:
+            return None
         result = {"status": True, "message": "The menu has been deleted"}
-        await cashe.change_menu_cashe(menu_id)
+        tags = ["menus", "menu:" + menu_id, "submenus:" + menu_id]
+        for submenu_id in submenu_ids:
+            tags += ["submenu:" + submenu_id, "subtree:" + submenu_id]
+        await self.commit(
+            *tags, versions=["menus", "menu:" + menu_id], changes=[change("delete", "menu", menu_id, id=menu_id)],
+        )
         return result
     
-    async def get_submenus(self):
-        redis_data = await cashe.get_cash("submenus")
-        if redis_data:
-            return redis_data
-        else:
-            # Get data from postgres
-            q = await self.db_session.execute(select(Submenu).options(selectinload(Submenu.dishes)))
-            my_db = q.scalars().all()
-            if my_db:
-                res = []
-                for instance in my_db:
-                    menu_dict = jsonable_encoder(instance)
-                    menu_dict["dishes_count"] = (len(instance.dishes))
-                    res.append(menu_dict)
-                await cashe.set_cash(res, "menus")
-                return res
-            await cashe.set_cash(my_db, "submenus")
-            return my_db
+    async def get_menu_tree(self, menu_id: str, version: Optional[int]) -> Optional[bytes]:
+        # The menu version is part of the key: any write in the menu bumps it,
+        # so readers move to a new entry and the old one just expires.
+        # Without a version (none made yet, or Redis unavailable) there is nothing to key it by.
+        if version is None:
+            return cashe.encode_loaded(await self.load_menu_tree(menu_id))
+        return await cashe.get_or_set("tree%s:%s" % (menu_id, version), lambda: self.load_menu_tree(menu_id))
+
+    async def load_menu_tree(self, menu_id: str):
+        if self.db_session.bind.dialect.name == "postgresql":
+            return await self.load_menu_tree_json(menu_id)
+        # One outer join of the menu with its submenus and dishes, nested here
+        q = await self.db_session.execute(
+            select(
+                Menu.id, Menu.title, Menu.description,
+                Submenu.id.label("submenu_id"),
+                Submenu.title.label("submenu_title"),
+                Submenu.description.label("submenu_description"),
+                Dish.id.label("dish_id"),
+                Dish.title.label("dish_title"),
+                Dish.description.label("dish_description"),
+                Dish.price.label("dish_price"),
+            )
+            .outerjoin(Submenu, Submenu.main_menu_id == Menu.id)
+            .outerjoin(Dish, Dish.submenu_id == Submenu.id)
+            .where(Menu.id == menu_id)
+            .order_by(Submenu.id, Dish.id)
+        )
+        tree = None
+        for row in q:
+            if tree is None:
+                tree = {"id": row.id, "title": row.title, "description": row.description, "submenus": []}
+            if row.submenu_id is None:
+                continue
+            if not tree["submenus"] or tree["submenus"][-1]["id"] != row.submenu_id:
+                tree["submenus"].append({
+                    "id": row.submenu_id,
+                    "title": row.submenu_title,
+                    "description": row.submenu_description,
+                    "main_menu_id": row.id,
+                    "dishes": [],
+                })
+            if row.dish_id is not None:
+                tree["submenus"][-1]["dishes"].append({
+                    "id": row.dish_id,
+                    "title": row.dish_title,
+                    "description": row.dish_description,
+                    "price": row.dish_price,
+                    "submenu_id": row.submenu_id,
+                })
+        return tree
+
+    async def load_menu_tree_json(self, menu_id: str) -> Optional[bytes]:
+        # Postgres builds the whole document, it is cached as it comes
+        dishes = (
+            select(json_array(
+                json_object(
+                    id=Dish.id, title=Dish.title, description=Dish.description,
+                    price=cast(Dish.price, Text), submenu_id=Dish.submenu_id,
+                ),
+                Dish.id,
+            ))
+            .where(Dish.submenu_id == Submenu.id)
+            .scalar_subquery()
+        )
+        submenus = (
+            select(json_array(
+                json_object(
+                    id=Submenu.id, title=Submenu.title, description=Submenu.description,
+                    main_menu_id=Submenu.main_menu_id, dishes=dishes,
+                ),
+                Submenu.id,
+            ))
+            .where(Submenu.main_menu_id == Menu.id)
+            .scalar_subquery()
+        )
+        tree = json_object(id=Menu.id, title=Menu.title, description=Menu.description, submenus=submenus)
+        q = await self.db_session.execute(select(cast(tree, Text)).where(Menu.id == menu_id))
+        tree = q.scalar()
+        if tree is None:
+            return None
+        return tree.encode()
+
+    def submenus_query(self):
+        return select(Submenu.title, Submenu.description, Submenu.id, Submenu.main_menu_id, Submenu.dishes_count)
+
+    async def get_page(self, q, id_column, cursor: Optional[str], limit: int) -> bytes:
+        # Keyset pagination: the cursor is the last id of the previous page
+        if cursor:
+            q = q.where(id_column > cursor)
+        q = await self.db_session.execute(q.order_by(id_column).limit(limit + 1))
+        rows = [row._asdict() for row in q]
+        next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+        return cashe.encode_page(rows[:limit], next_cursor)
+
+    async def get_submenus(self, menu_id: str, cursor: Optional[str] = None, limit: int = PAGE_SIZE):
+        # returns the page body and the cursor of the next page
+        limit = min(limit, MAX_PAGE_SIZE)
+        q = self.submenus_query().where(Submenu.main_menu_id == menu_id)
+        page = await cashe.get_or_set(
+            cashe.submenus_key(menu_id),
+            lambda: self.get_page(q, Submenu.id, cursor, limit),
+            cashe.page_field(cursor, limit),
+            tags=["submenus:" + menu_id],
+        )
+        return cashe.decode_page(page)
 
     async def create_submenu(self, submenu: schemas.SubmenuCreate, main_menu_id: str):
         new_submenu = Submenu(title=submenu.title, description=submenu.description, main_menu_id=main_menu_id)
         self.db_session.add(new_submenu)
         await self.db_session.flush()
-        await cashe.change_submenu_cashe(main_menu_id)
+        await self.add_counts(main_menu_id, submenus=1)
+        await self.commit(
+            "menus", "menu:" + main_menu_id, "submenus:" + main_menu_id, versions=["menus", "menu:" + main_menu_id],
+            changes=[change(
+                "create", "submenu", main_menu_id, id=new_submenu.id, title=new_submenu.title,
+                description=new_submenu.description, main_menu_id=main_menu_id,
+            )],
+        )
         return new_submenu
 
-    async def get_submenu(self, submenu_id: str):
-        # Get data from redis
-        redis_data = await cashe.get_cash("submenu" + submenu_id)
-        if redis_data:
-            return redis_data
-        else:
-            my_db = await self.db_session.execute(select(Submenu).where(Submenu.id == submenu_id).options(selectinload(Submenu.dishes)))
-            my_db = my_db.scalars().all()
-            if my_db:
-                res = jsonable_encoder(my_db)
-                res[0]["dishes_count"] = len(res[0]["dishes"])
-                del res[0]["dishes"]
-                print(res)
-                await cashe.set_cash(res, "submenu" + submenu_id)
-                return res[0]
-            await cashe.set_cash(my_db, "submenu" + submenu_id)
-            return my_db
-
-    async def update_submenu(self, submenu: schemas.SubmenuBase, api_test_submenu_id):
-        q = update(Submenu).where(Submenu.id == api_test_submenu_id)
-        q = q.values(title=submenu.title)
-        q = q.values(description=submenu.description)
-        q.execution_options(synchronize_session="fetch")
-        await self.db_session.execute(q)
-        await cashe.change_submenu_cashe("", api_test_submenu_id)
-        db_submenu = await self.get_submenu(submenu_id=api_test_submenu_id)
-        await cashe.change_submenu_cashe("", api_test_submenu_id)
+    async def get_submenu(self, submenu_id: str) -> Optional[bytes]:
+        return await cashe.get_or_set(
+            "submenu" + submenu_id, lambda: self.load_submenu(submenu_id), tags=["submenu:" + submenu_id],
+        )
+
+    async def load_submenu(self, submenu_id: str) -> Optional[dict]:
+        # Get data from postgres
+        q = await self.db_session.execute(self.submenus_query().where(Submenu.id == submenu_id))
+        row = q.first()
+        if row is None:
+            return None
+        return row._asdict()
+
+    async def update_submenu(self, submenu: schemas.SubmenuBase, api_test_submenu_id, api_test_menu_id) -> Optional[bytes]:
+        # like update_menu, None unless the submenu is in the path's menu as GET requires
+        q = (
+            update(Submenu).where(Submenu.id == api_test_submenu_id, Submenu.main_menu_id == api_test_menu_id)
+            .values(title=submenu.title, description=submenu.description)
+            .returning(*self.submenus_query().selected_columns)
+            .execution_options(synchronize_session=False)
+        )
+        row = (await self.db_session.execute(q)).first()
+        if row is None:
+            return None
+        db_submenu = cashe.encode(row._asdict())
+        menu_id = api_test_menu_id
+        await self.commit(
+            "submenus:" + menu_id, "submenu:" + api_test_submenu_id, versions=["menu:" + menu_id],
+            refresh=("submenu" + api_test_submenu_id, db_submenu, ["submenu:" + api_test_submenu_id], {}),
+            changes=[change("update", "submenu", menu_id, **row._asdict())],
+        )
         return db_submenu
 
-    async def delete_submenu(self, submenu_id: str, menu_id: str):
-        q = delete(Submenu).where(Submenu.id == submenu_id)
-        res = await self.db_session.execute(q)
+    async def delete_submenu(self, submenu_id: str, menu_id: str) -> Optional[dict]:
+        q = (
+            delete(Submenu).where(Submenu.id == submenu_id, Submenu.main_menu_id == menu_id)
+            .returning(Submenu.dishes_count)
+        )
+        row = (await self.db_session.execute(q)).first()
+        if row is None:
+            return None
+        # its dishes go with it
+        await self.add_counts(menu_id, submenus=-1, dishes=-row.dishes_count)
         result = {"status": True, "message": "The submenu has been deleted"}
-        await cashe.change_submenu_cashe(menu_id, submenu_id)
+        await self.commit(
+            "menus", "menu:" + menu_id, "submenus:" + menu_id, "submenu:" + submenu_id, "subtree:" + submenu_id,
+            versions=["menus", "menu:" + menu_id], changes=[change("delete", "submenu", menu_id, id=submenu_id)],
+        )
         return result
 
     async def create_dish(self, dish: schemas.DishCreate, submenu_id: str, menu_id: str):
+        # None unless the submenu is in the path's menu, see in_submenu
+        q = select(Submenu.id).where(Submenu.id == submenu_id, Submenu.main_menu_id == menu_id)
+        if (await self.db_session.execute(q)).first() is None:
+            return None
         new_dish = Dish(title=dish.title, description=dish.description, price=dish.price, submenu_id=submenu_id)
         self.db_session.add(new_dish)
         await self.db_session.flush()
-        await cashe.change_dish_cashe(menu_id, submenu_id)
+        await self.add_dishes_count(submenu_id, 1)
+        await self.commit(
+            "menus", "menu:" + menu_id, "submenus:" + menu_id, "submenu:" + submenu_id, "dishes:" + submenu_id,
+            versions=["menus", "menu:" + menu_id],
+            changes=[change(
+                "create", "dish", menu_id, id=new_dish.id, title=new_dish.title, description=new_dish.description,
+                price=new_dish.price, submenu_id=submenu_id,
+            )],
+        )
         return new_dish
 
-    async def get_dishes(self):
-        redis_data =await cashe.get_cash("dishes")
-        if redis_data:
-            return redis_data
-        else:
-            # Get data from postgres
-            q = await self.db_session.execute(select(Dish))
-            res = q.scalars().all()
-            await cashe.set_cash(res, "dishes")
-            return res
-
-    async def get_dish(self, dish_id: str):
-        redis_data = await cashe.get_cash("dish" + dish_id)
-        if redis_data:
-            return redis_data
-        else:
-            # Get data from postgres
-            my_db = await self.db_session.execute(select(Dish).where(Dish.id == dish_id))
-            my_db = my_db.scalars().all()
-            if not my_db:
-                raise HTTPException(status_code=404, detail="dish not found")
-            await cashe.set_cash(my_db[0], "dish" + dish_id)
-            return my_db[0]
-
-    async def update_dish(self, dish: schemas.DishBase, api_test_dish_id: str, api_test_submenu_id: str, api_test_menu_id: str):
-        q = update(Dish).where(Dish.id == api_test_dish_id)
-        q = q.values(title=dish.title)
-        q = q.values(description=dish.description)
-        q = q.values(price=dish.price)
-        q.execution_options(synchronize_session="fetch")
-        await self.db_session.execute(q)
-        db_dish = await self.get_dish(dish_id=api_test_dish_id)
-        await cashe.change_dish_cashe(
-            api_test_menu_id, api_test_submenu_id, api_test_dish_id,
+    async def get_dishes(self, submenu_id: str, cursor: Optional[str] = None, limit: int = PAGE_SIZE):
+        # returns the page body and the cursor of the next page
+        limit = min(limit, MAX_PAGE_SIZE)
+        q = self.dishes_query().where(Dish.submenu_id == submenu_id)
+        page = await cashe.get_or_set(
+            cashe.dishes_key(submenu_id),
+            lambda: self.get_page(q, Dish.id, cursor, limit),
+            cashe.page_field(cursor, limit),
+            tags=["dishes:" + submenu_id, "subtree:" + submenu_id],
+        )
+        return cashe.decode_page(page)
+
+    async def stream_dishes(self, submenu_id: str):
+        async for chunk in self.stream_list(self.dishes_query().where(Dish.submenu_id == submenu_id).order_by(Dish.id)):
+            yield chunk
+
+    def dishes_query(self):
+        return select(Dish.title, Dish.description, Dish.price, Dish.id, Dish.submenu_id)
+
+    async def get_dish(self, dish_id: str) -> bytes:
+        db_dish = await cashe.get_or_set(
+            "dish" + dish_id,
+            lambda: self.load_dish(dish_id),
+            tags=["dish:" + dish_id],
+            data_tags=lambda data: ["subtree:" + data["submenu_id"]],
+        )
+        if db_dish is None:
+            raise HTTPException(status_code=404, detail="dish not found")
+        return db_dish
+
+    async def load_dish(self, dish_id: str) -> Optional[dict]:
+        # Get data from postgres
+        q = await self.db_session.execute(self.dishes_query().where(Dish.id == dish_id))
+        row = q.first()
+        if row is None:
+            return None
+        return row._asdict()
+
+    async def update_dish(self, dish: schemas.DishBase, api_test_dish_id: str, api_test_submenu_id: str, api_test_menu_id: str) -> Optional[bytes]:
+        # like update_menu, None unless the dish is where the path says, see in_submenu.
+        # The cached dish is also tagged "subtree:<submenu_id>", which this write doesn't
+        # invalidate: its epoch is read before the update, so a submenu delete committed
+        # after it still keeps the written-through dish out of the cache.
+        subtree = "subtree:" + api_test_submenu_id
+        epochs = await cashe.get_epochs([subtree])
+        q = (
+            update(Dish).where(Dish.id == api_test_dish_id, in_submenu(api_test_submenu_id, api_test_menu_id))
+            .values(title=dish.title, description=dish.description, price=dish.price)
+            .returning(*self.dishes_query().selected_columns)
+            .execution_options(synchronize_session=False)
+        )
+        row = (await self.db_session.execute(q)).first()
+        if row is None:
+            return None
+        db_dish = cashe.encode(row._asdict())
+        await self.commit(
+            "dishes:" + api_test_submenu_id, "dish:" + api_test_dish_id, versions=["menu:" + api_test_menu_id],
+            refresh=("dish" + api_test_dish_id, db_dish, ["dish:" + api_test_dish_id, subtree], epochs),
+            changes=[change("update", "dish", api_test_menu_id, **row._asdict())],
         )
-        db_dish = await self.get_dish(dish_id=api_test_dish_id)
         return db_dish
 
-    async def delete_dish(self, dish_id: str, api_test_submenu_id: str, api_test_menu_id: str):
-        q = delete(Dish).where(Dish.id == dish_id)
-        res = await self.db_session.execute(q)
+    async def delete_dish(self, dish_id: str, api_test_submenu_id: str, api_test_menu_id: str) -> Optional[dict]:
+        q = delete(Dish).where(Dish.id == dish_id, in_submenu(api_test_submenu_id, api_test_menu_id)).returning(Dish.id)
+        if (await self.db_session.execute(q)).first() is None:
+            return None
+        submenu_id, menu_id = api_test_submenu_id, api_test_menu_id
+        await self.add_dishes_count(submenu_id, -1)
         result = {"status": True, "message": "The dish has been deleted"}
-        await cashe.change_dish_cashe(api_test_menu_id, api_test_submenu_id, dish_id)
+        await self.commit(
+            "menus", "menu:" + menu_id, "submenus:" + menu_id,
+            "submenu:" + submenu_id, "dishes:" + submenu_id, "dish:" + dish_id,
+            versions=["menus", "menu:" + menu_id],
+            changes=[change("delete", "dish", menu_id, id=dish_id, submenu_id=submenu_id)],
+        )
+        return result
+
+    async def batch_submenus(
+        self, menu_id: str, creates: List[schemas.SubmenuCreate], updates: List[schemas.SubmenuUpdate],
+    ) -> Optional[dict]:
+        # Creates and partial updates of the menu's submenus in one transaction with
+        # multi-row statements, then one invalidation. None if there is no such menu.
+        if (await self.db_session.execute(select(Menu.id).where(Menu.id == menu_id))).first() is None:
+            return None
+        created = [
+            {"id": generate_uuid(), "title": item.title, "description": item.description, "main_menu_id": menu_id, "dishes_count": 0}
+            for item in creates
+        ]
+        if created:
+            await self.db_session.execute(insert(Submenu), created)
+            await self.add_counts(menu_id, submenus=len(created))
+        found = await self.update_rows(Submenu, updates, Submenu.main_menu_id == menu_id)
+        rows = await self.db_session.execute(self.submenus_query().where(Submenu.id.in_(found)))
+        rows = {row.id: row._asdict() for row in rows}
+        result = {
+            "create": [{"status": 201, "item": row} for row in created],
+            "update": [
+                {"status": 200, "item": rows[item.id]} if item.id in rows else {"status": 404, "detail": "submenu not found"}
+                for item in updates
+            ],
+        }
+        if not created and not rows:
+            return result
+        tags = ["submenus:" + menu_id] + ["submenu:" + submenu_id for submenu_id in rows]
+        versions = ["menu:" + menu_id]
+        if created:
+            tags += ["menus", "menu:" + menu_id]
+            versions.append("menus")
+        changes = [change("create", "submenu", menu_id, **row) for row in created]
+        changes += [change("update", "submenu", menu_id, **row) for row in rows.values()]
+        await self.commit(*tags, versions=versions, changes=changes)
         return result
+
+    async def batch_dishes(
+        self, menu_id: str, creates: List[schemas.DishBatchCreate], updates: List[schemas.DishUpdate],
+    ) -> Optional[dict]:
+        # Creates and partial updates of dishes anywhere in the menu, see batch_submenus.
+        # Items whose submenu or dish is not in the menu get a 404 result.
+        if (await self.db_session.execute(select(Menu.id).where(Menu.id == menu_id))).first() is None:
+            return None
+        submenu_ids = {item.submenu_id for item in creates}
+        if submenu_ids:
+            q = select(Submenu.id).where(Submenu.id.in_(submenu_ids), Submenu.main_menu_id == menu_id)
+            submenu_ids = set((await self.db_session.scalars(q)).all())
+        created = [
+            {"id": generate_uuid(), **item.dict()} if item.submenu_id in submenu_ids else None
+            for item in creates
+        ]
+        rows = [row for row in created if row is not None]
+        if rows:
+            await self.db_session.execute(insert(Dish), rows)
+            for submenu_id, count in Counter(row["submenu_id"] for row in rows).items():
+                q = (
+                    update(Submenu).where(Submenu.id == submenu_id)
+                    .values(dishes_count=Submenu.dishes_count + count)
+                    .execution_options(synchronize_session=False)
+                )
+                await self.db_session.execute(q)
+            await self.add_counts(menu_id, dishes=len(rows))
+        in_menu = Dish.submenu_id.in_(select(Submenu.id).where(Submenu.main_menu_id == menu_id))
+        found = await self.update_rows(Dish, updates, in_menu)
+        updated = await self.db_session.execute(self.dishes_query().where(Dish.id.in_(found)))
+        updated = {row.id: row._asdict() for row in updated}
+        result = {
+            "create": [
+                {"status": 201, "item": row} if row is not None else {"status": 404, "detail": "submenu not found"}
+                for row in created
+            ],
+            "update": [
+                {"status": 200, "item": updated[item.id]} if item.id in updated else {"status": 404, "detail": "dish not found"}
+                for item in updates
+            ],
+        }
+        tags = []
+        versions = ["menu:" + menu_id]
+        if rows:
+            tags += ["menus", "menu:" + menu_id, "submenus:" + menu_id]
+            for submenu_id in {row["submenu_id"] for row in rows}:
+                tags += ["submenu:" + submenu_id, "dishes:" + submenu_id]
+            versions.append("menus")
+        for dish_id, row in updated.items():
+            tags += ["dishes:" + row["submenu_id"], "dish:" + dish_id]
+        if tags:
+            changes = [change("create", "dish", menu_id, **row) for row in rows]
+            changes += [change("update", "dish", menu_id, **row) for row in updated.values()]
+            await self.commit(*tags, versions=versions, changes=changes)
+        return result
+
+    async def update_rows(self, model, updates: list, *scope) -> set:
+        # One executemany UPDATE by primary key of the rows that exist within scope;
+        # only the fields set in each item are written. Returns the ids found.
+        ids = {item.id for item in updates}
+        if not ids:
+            return set()
+        found = set((await self.db_session.scalars(select(model.id).where(model.id.in_(ids), *scope))).all())
+        rows = [item.dict(exclude_unset=True) for item in updates if item.id in found]
+        rows = [row for row in rows if len(row) > 1]
+        if rows:
+            await self.db_session.execute(update(model), rows)
+        return found
+
+    async def search(self, terms: str, kinds: List[str], menu_id: Optional[str], cursor: Optional[str], limit: int):
+        # Menus, submenus and dishes whose title or description has words starting with
+        # every word of terms, best match first. Returns the page body and the next cursor,
+        # an offset: ranked results have no stable key to continue from.
+        words = re.findall(r"\w+", terms)[:SEARCH_MAX_WORDS]
+        offset = int(cursor) if cursor and cursor.isdigit() else 0
+        if not words or not kinds:
+            return cashe.encode([]), None
+        if self.db_session.bind.dialect.name == "postgresql":
+            match = func.to_tsquery(literal_column("'simple'::regconfig"), " & ".join(word + ":*" for word in words))
+        else:
+            match = " ".join('"%s"*' % word for word in words)
+        q = union_all(*[self.search_query(kind, match, menu_id) for kind in kinds]).subquery()
+        # relabelled, the subquery's names are not plain strings and orjson wants those
+        columns = [column.label(str(column.name)) for column in q.c if column.name != "rank"]
+        q = select(*columns).order_by(q.c.rank.desc(), q.c.kind, q.c.id)
+        rows = [row._asdict() for row in await self.replica_session.execute(q.offset(offset).limit(limit + 1))]
+        next_cursor = str(offset + limit) if len(rows) > limit else None
+        return cashe.encode(rows[:limit]), next_cursor
+
+    def search_query(self, kind: str, match, menu_id: Optional[str]):
+        # kind, id, title, description, price, menu_id, submenu_id, rank (higher is better)
+        model = {"menu": Menu, "submenu": Submenu, "dish": Dish}[kind]
+        if self.db_session.bind.dialect.name == "postgresql":
+            vector = search_vector(model.title, model.description)
+            q = select(model).where(vector.op("@@")(match))
+            rank = func.ts_rank(vector, match)
+        else:
+            # the FTS5 table shares rowids with its content table, bm25 is lower for better matches
+            fts = table(model.__tablename__ + "_search")
+            q = (
+                select(model)
+                .join(fts, literal_column(fts.name + ".rowid") == literal_column(model.__tablename__ + ".rowid"))
+                .where(literal_column(fts.name).op("MATCH")(match))
+            )
+            rank = -func.bm25(literal_column(fts.name), 10.0, 1.0)
+        # typed, so the union has one type per column and decodes ids and prices
+        no_price, no_submenu = cast(null(), Dish.price.type), cast(null(), Dish.submenu_id.type)
+        if kind == "menu":
+            columns = [no_price, Menu.id, no_submenu]
+            scope = Menu.id
+        elif kind == "submenu":
+            columns = [no_price, Submenu.main_menu_id, no_submenu]
+            scope = Submenu.main_menu_id
+        else:
+            q = q.join(Submenu, Submenu.id == Dish.submenu_id)
+            columns = [Dish.price, Submenu.main_menu_id, Dish.submenu_id]
+            scope = Submenu.main_menu_id
+        if menu_id is not None:
+            q = q.where(scope == menu_id)
+        return q.with_only_columns(
+            literal_column("'%s'" % kind, String).label("kind"), model.id.label("id"), model.title.label("title"),
+            model.description.label("description"), columns[0].label("price"), columns[1].label("menu_id"),
+            columns[2].label("submenu_id"), rank.label("rank"),
+            maintain_column_froms=True,
+        )
+
+    async def add_counts(self, menu_id: str, submenus: int = 0, dishes: int = 0):
+        # relative updates, so concurrent writers don't lose each other's changes
+        q = (
+            update(Menu).where(Menu.id == menu_id)
+            .values(submenus_count=Menu.submenus_count + submenus, dishes_count=Menu.dishes_count + dishes)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db_session.execute(q)
+
+    async def add_dishes_count(self, submenu_id: str, dishes: int):
+        # the submenu and its menu
+        q = (
+            update(Submenu).where(Submenu.id == submenu_id)
+            .values(dishes_count=Submenu.dishes_count + dishes)
+            .returning(Submenu.main_menu_id)
+            .execution_options(synchronize_session=False)
+        )
+        menu_id = (await self.db_session.execute(q)).scalar()
+        if menu_id is not None:
+            await self.add_counts(menu_id, dishes=dishes)
+        return menu_id
+
+    async def recount(self, menu_ids=None, submenu_ids=None):
+        # Recompute the stored counts from the rows, of every menu and submenu when no ids
+        # are given. Returns the ids of the menus and submenus whose counts were wrong.
+        dishes_count = select(func.count(Dish.id)).where(Dish.submenu_id == Submenu.id).scalar_subquery()
+        q = update(Submenu).where(Submenu.dishes_count != dishes_count)
+        if submenu_ids is not None:
+            q = q.where(Submenu.id.in_(submenu_ids))
+        q = q.values(dishes_count=dishes_count).returning(Submenu.id, Submenu.main_menu_id)
+        fixed_submenus = (await self.db_session.execute(q.execution_options(synchronize_session=False))).all()
+
+        submenus_count = select(func.count(Submenu.id)).where(Submenu.main_menu_id == Menu.id).scalar_subquery()
+        dishes_count = (
+            select(func.coalesce(func.sum(Submenu.dishes_count), 0))
+            .where(Submenu.main_menu_id == Menu.id)
+            .scalar_subquery()
+        )
+        q = update(Menu).where((Menu.submenus_count != submenus_count) | (Menu.dishes_count != dishes_count))
+        if menu_ids is not None:
+            q = q.where(Menu.id.in_(set(menu_ids) | {row.main_menu_id for row in fixed_submenus}))
+        q = q.values(submenus_count=submenus_count, dishes_count=dishes_count).returning(Menu.id)
+        fixed_menus = (await self.db_session.execute(q.execution_options(synchronize_session=False))).scalars().all()
+        return fixed_menus, [row.id for row in fixed_submenus]
+
+    async def repair_counts(self):
+        # Fix every stored count and drop what was cached with the wrong ones
+        menu_ids, submenu_ids = await self.recount()
+        tags = ["menus"]
+        for menu_id in menu_ids:
+            tags += ["menu:" + menu_id, "submenus:" + menu_id]
+        tags += ["submenu:" + submenu_id for submenu_id in submenu_ids]
+        await self.commit(
+            *tags, versions=["menus"] + ["menu:" + menu_id for menu_id in menu_ids],
+            changes=[cashe.RELOAD] if menu_ids or submenu_ids else [],
+        )
+        return {"menus": len(menu_ids), "submenus": len(submenu_ids)}
+
+    async def upsert(self, model, rows: List[dict]):
+        # INSERT ... ON CONFLICT (id) DO UPDATE; with RETURNING, SQLAlchemy sends
+        # the rows as multi-row VALUES statements instead of one statement per row
+        if not rows:
+            return
+        table = model.__table__
+        if self.db_session.bind.dialect.name == "postgresql":
+            q = postgresql.insert(table)
+        else:
+            q = sqlite.insert(table)
+        q = q.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={name: q.excluded[name] for name in rows[0] if name != "id"},
+        )
+        await self.db_session.execute(q.returning(table.c.id), rows)
+
+    async def import_batch(self, menus: List[dict], submenus: List[dict], dishes: List[dict], lines: dict):
+        # Returns the cache tags and versions the batch has changed. lines has the line
+        # numbers of the rows of each collection, for the errors of check_parents and check_titles.
+        await self.check_parents(Menu, "menu", submenus, "main_menu_id", {menu["id"] for menu in menus}, lines["submenus"])
+        await self.check_parents(Submenu, "submenu", dishes, "submenu_id", {submenu["id"] for submenu in submenus}, lines["dishes"])
+        await self.check_titles(menus, lines["menus"])
+        menu_ids = {menu["id"] for menu in menus} | {submenu["main_menu_id"] for submenu in submenus}
+        submenu_ids = {submenu["id"] for submenu in submenus} | {dish["submenu_id"] for dish in dishes}
+        # rows moved to another parent leave a wrong count at the old one
+        if submenus:
+            q = await self.db_session.execute(
+                select(Submenu.main_menu_id).where(Submenu.id.in_([submenu["id"] for submenu in submenus])).distinct()
+            )
+            menu_ids.update(q.scalars())
+        if dishes:
+            q = await self.db_session.execute(
+                select(Dish.submenu_id).where(Dish.id.in_([dish["id"] for dish in dishes])).distinct()
+            )
+            submenu_ids.update(q.scalars())
+        await self.upsert(Menu, menus)
+        await self.upsert(Submenu, submenus)
+        await self.upsert(Dish, dishes)
+        if dishes:
+            # dish counts of the menus above the dishes' submenus
+            q = await self.db_session.execute(
+                select(Submenu.main_menu_id).where(Submenu.id.in_(submenu_ids)).distinct()
+            )
+            menu_ids.update(q.scalars())
+        await self.recount(menu_ids, submenu_ids)
+        tags = ["menus"]
+        for menu_id in menu_ids:
+            tags += ["menu:" + menu_id, "submenus:" + menu_id]
+        for submenu_id in submenu_ids:
+            tags += ["submenu:" + submenu_id, "dishes:" + submenu_id]
+        tags += ["dish:" + dish["id"] for dish in dishes]
+        return tags, ["menus"] + ["menu:" + menu_id for menu_id in menu_ids]
+
+    async def check_parents(self, parent, parent_kind: str, rows: List[dict], column: str, batch_ids: set, lines: List[int]):
+        # 422 for the first row whose parent is neither in the batch nor in the database
+        missing = {row[column] for row in rows} - batch_ids
+        if missing:
+            missing -= set((await self.db_session.scalars(select(parent.id).where(parent.id.in_(missing)))).all())
+        for row, line in zip(rows, lines):
+            if row[column] in missing:
+                raise HTTPException(status_code=422, detail="line %s: %s %s not found" % (line, parent_kind, row[column]))
+
+    async def check_titles(self, menus: List[dict], lines: List[int]):
+        # Menu titles are unique: 409 for a title another menu has, in the batch or in the
+        # database. A menu of the batch keeps its old title only if the batch doesn't change it.
+        titles = {}
+        for menu, line in zip(menus, lines):
+            menu_id, _ = titles.setdefault(menu["title"], (menu["id"], line))
+            if menu_id != menu["id"]:
+                raise HTTPException(status_code=409, detail="line %s: menu title %r is used by menu %s" % (line, menu["title"], menu_id))
+        if not titles:
+            return
+        batch_ids = {menu["id"] for menu in menus}
+        for row in await self.db_session.execute(select(Menu.id, Menu.title).where(Menu.title.in_(titles))):
+            menu_id, line = titles[row.title]
+            if row.id != menu_id and row.id not in batch_ids:
+                raise HTTPException(status_code=409, detail="line %s: menu title %r is used by menu %s" % (line, row.title, row.id))
+
+    async def export_records(self):
+        # NDJSON of the whole tree, parents before children so it can be imported back.
+        # Rows come from a server-side cursor, memory does not grow with the catalog.
+        queries = (
+            ("menu", select(Menu.id, Menu.title, Menu.description).order_by(Menu.id)),
+            ("submenu", select(Submenu.id, Submenu.main_menu_id, Submenu.title, Submenu.description).order_by(Submenu.id)),
+            ("dish", select(Dish.id, Dish.submenu_id, Dish.title, Dish.description, Dish.price).order_by(Dish.id)),
+        )
+        for record_type, q in queries:
+            result = await self.replica_session.stream(q.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+            async for rows in result.partitions():
+                yield b"".join(cashe.encode({"type": record_type, **row._asdict()}) + b"\n" for row in rows)
+
+
+def in_submenu(submenu_id: str, menu_id: str):
+    # Dishes in the submenu, if that is in the menu. Writes through a path check it like
+    # GET does, so every method answers 404 for a dish, submenu or menu the path misplaces.
+    return Dish.submenu_id.in_(select(Submenu.id).where(Submenu.id == submenu_id, Submenu.main_menu_id == menu_id))
+
+
+def change(op: str, kind: str, menu_id: str, **row) -> dict:
+    # An event of the change feed: the row as written, only its ids when deleted.
+    # Subscribers adjust the counts of the parents on creates and deletes themselves.
+    return {"op": op, "kind": kind, "menu_id": menu_id, **row}
+
+
+def json_object(**fields):
+    # json_build_object('name', value, ...), names are rendered inline
+    return func.json_build_object(*[
+        arg for name, value in fields.items() for arg in (literal_column("'%s'" % name), value)
+    ])
+
+
+def json_array(element, order_by):
+    # json array of element, '[]' instead of null when there are no rows
+    return func.coalesce(
+        func.json_agg(postgresql.aggregate_order_by(element, order_by)),
+        literal_column("'[]'::json"),
+    )
+
+
+IMPORT_COLLECTIONS = {"menu": "menus", "submenu": "submenus", "dish": "dishes"}
+
+
+@metrics.label("import_records")
+async def import_records(records) -> dict:
+    # records is an async iterable of (line number, "menu" | "submenu" | "dish", row dict).
+    # Every batch is committed in its own transaction, then its cache tags are invalidated once.
+    # A batch that can't be imported fails with the line of the row at fault, 409 for
+    # constraint violations the checks of import_batch don't catch; the batches before it
+    # stay imported, and since rows are upserted the whole import can be sent again.
+    batch = {"menus": [], "submenus": [], "dishes": []}
+    lines = {"menus": [], "submenus": [], "dishes": []}
+    imported = {"menus": 0, "submenus": 0, "dishes": 0}
+
+    async def flush():
+        if not any(batch.values()):
+            return
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    tags, versions = await BookDAL(session).import_batch(**batch, lines=lines)
+        except IntegrityError:
+            numbers = [number for numbers in lines.values() for number in numbers]
+            raise HTTPException(status_code=409, detail="lines %s-%s: conflict with existing rows" % (min(numbers), max(numbers)))
+        await cashe.invalidate(*tags, versions=versions)
+        for name, rows in batch.items():
+            imported[name] += len(rows)
+            rows.clear()
+            lines[name].clear()
+
+    async for line, record_type, row in records:
+        row.setdefault("id", None)
+        if row["id"] is None:
+            row["id"] = generate_uuid()
+        batch[IMPORT_COLLECTIONS[record_type]].append(row)
+        lines[IMPORT_COLLECTIONS[record_type]].append(line)
+        if sum(len(rows) for rows in batch.values()) >= IMPORT_BATCH_SIZE:
+            await flush()
+    await flush()
+    if any(imported.values()):
+        # too many rows for events, subscribers load everything again
+        await cashe.publish_changes([cashe.RELOAD])
+    return imported
+
+
+@metrics.label("warm_up")
+async def warm_up(concurrency: int, max_menus: int) -> int:
+    # Load the menu list, then every menu and its first submenu page, at most
+    # concurrency at a time. Keys already cached are only read. Returns the menus warmed.
+    async with async_session() as session:
+        menus = orjson.loads(await BookDAL(session).get_menus())[:max_menus]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def warm(menu_id):
+        async with semaphore:
+            async with async_session() as session:
+                book_dal = BookDAL(session)
+                await book_dal.get_menu(menu_id)
+                await book_dal.get_submenus(menu_id)
+
+    await asyncio.gather(*[warm(menu["id"]) for menu in menus])
+    return len(menus)
@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import logging
+import re
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import Column, Integer, Table, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.config import Base, engine
+from db.dals.book_dal import BookDAL
+from db.models.book import Menu, Submenu, Dish
+
+logger = logging.getLogger(__name__)
+
+# one row, the version of the schema the database is at
+schema_version = Table("schema_version", Base.metadata, Column("version", Integer, nullable=False))
+
+# any constant, taken by every worker that checks the schema so only one migrates at a time
+MIGRATION_LOCK_ID = 72_311_904
+
+
+class SchemaError(RuntimeError):
+    pass
+
+
+async def prepare_schema(mode: str):
+    # Run at startup:
+    #   "verify"    fail unless the schema is current, for workers that must not change it
+    #   "migrate"   bring the schema up to date, creating it on an empty database
+    #   "recreate"  drop and create every table, all data is lost (tests, benchmarks)
+    if mode == "recreate":
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            await set_version(conn, LATEST_VERSION)
+        return
+    if mode not in ("verify", "migrate"):
+        raise SchemaError("unknown schema mode %r, expected verify, migrate or recreate" % mode)
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # held until commit, other workers wait here and then find nothing left to do
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        elif conn.dialect.name == "sqlite":
+            # no advisory locks, the database's write lock serializes the workers instead
+            await conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = await get_version(conn)
+        if version == LATEST_VERSION:
+            return
+        if mode == "verify":
+            raise SchemaError(
+                "database schema is at version %s, this code needs %s; migrate it with python -m db.migrations"
+                % (version, LATEST_VERSION)
+            )
+        if version is None:
+            logger.info("creating schema version %s", LATEST_VERSION)
+            await conn.run_sync(Base.metadata.create_all)
+        else:
+            for to_version, description, migrate in MIGRATIONS:
+                if to_version > version:
+                    logger.info("migrating schema to version %s: %s", to_version, description)
+                    await migrate(conn)
+            # with the models' types only once the tables match them again
+            async with AsyncSession(bind=conn) as session:
+                await BookDAL(session).recount()
+        await set_version(conn, LATEST_VERSION)
+
+
+async def get_version(conn):
+    # None for an empty database, 0 for tables created before versions were kept
+    tables = await conn.run_sync(lambda sync_conn: set(inspect(sync_conn).get_table_names()))
+    if schema_version.name in tables:
+        return (await conn.execute(select(schema_version.c.version))).scalar()
+    if Menu.__tablename__ in tables:
+        return 0
+    return None
+
+
+async def set_version(conn, version: int):
+    await conn.run_sync(schema_version.create, checkfirst=True)
+    await conn.execute(schema_version.delete())
+    await conn.execute(schema_version.insert().values(version=version))
+
+
+async def add_counters_and_search(conn):
+    # counter columns, search indexes instead of the description indexes
+    def upgrade(sync_conn):
+        inspector = inspect(sync_conn)
+        for model in (Menu, Submenu, Dish):
+            table = model.__table__
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for name in ("submenus_count", "dishes_count"):
+                if name in table.c and name not in existing:
+                    sync_conn.execute(text("ALTER TABLE %s ADD COLUMN %s INTEGER NOT NULL DEFAULT 0" % (table.name, name)))
+            sync_conn.execute(text("DROP INDEX IF EXISTS ix_%s_description" % table.name))
+            for index in table.indexes:
+                index.create(sync_conn, checkfirst=True)
+            if sync_conn.dialect.name == "sqlite":
+                for statement in table.info["sqlite_search_ddl"]:
+                    sync_conn.execute(text(statement.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS")))
+                sync_conn.execute(text("INSERT INTO %s_search(%s_search) VALUES ('rebuild')" % (table.name, table.name)))
+
+    await conn.run_sync(upgrade)
+    # the counters are filled in by the recount after the last migration
+
+
+# Ids that are not uuids become the uuid spelled by their md5, the same on both
+# databases, so references between rows still match after the conversion.
+LEGACY_UUID = "^[0-9a-f]{8}-?([0-9a-f]{4}-?){3}[0-9a-f]{12}$"
+POSTGRES_UUID = "CASE WHEN {0} ~* '%s' THEN {0}::uuid ELSE md5({0})::uuid END" % LEGACY_UUID.replace("{", "{{").replace("}", "}}")
+# prices that are not numbers become null
+LEGACY_PRICE = r"^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)\s*$"
+POSTGRES_PRICE = "CASE WHEN price ~ '%s' THEN round(price::numeric, 2) END" % LEGACY_PRICE
+
+
+async def uuid_keys_and_numeric_prices(conn):
+    # uuid ids and numeric(10, 2) prices instead of strings
+    if conn.dialect.name == "postgresql":
+        for statement in (
+            "ALTER TABLE dishes DROP CONSTRAINT IF EXISTS dishes_submenu_id_fkey",
+            "ALTER TABLE submenus DROP CONSTRAINT IF EXISTS submenus_main_menu_id_fkey",
+            "ALTER TABLE menus ALTER COLUMN id TYPE uuid USING %s" % POSTGRES_UUID.format("id"),
+            "ALTER TABLE submenus ALTER COLUMN id TYPE uuid USING %s, ALTER COLUMN main_menu_id TYPE uuid USING %s"
+            % (POSTGRES_UUID.format("id"), POSTGRES_UUID.format("main_menu_id")),
+            "ALTER TABLE dishes ALTER COLUMN id TYPE uuid USING %s, ALTER COLUMN submenu_id TYPE uuid USING %s, "
+            "ALTER COLUMN price TYPE numeric(10, 2) USING %s"
+            % (POSTGRES_UUID.format("id"), POSTGRES_UUID.format("submenu_id"), POSTGRES_PRICE),
+            "ALTER TABLE submenus ADD CONSTRAINT submenus_main_menu_id_fkey "
+            "FOREIGN KEY (main_menu_id) REFERENCES menus (id) ON DELETE CASCADE",
+            "ALTER TABLE dishes ADD CONSTRAINT dishes_submenu_id_fkey "
+            "FOREIGN KEY (submenu_id) REFERENCES submenus (id) ON DELETE CASCADE",
+        ):
+            await conn.execute(text(statement))
+        return
+
+    # sqlite can't change column types: copy the rows out, create the tables again, copy them back
+    def rebuild(sync_conn):
+        tables = [model.__table__ for model in (Menu, Submenu, Dish)]
+        rows = {}
+        for table in tables:
+            rows[table.name] = [
+                dict(row._mapping)
+                for row in sync_conn.execute(text("SELECT %s FROM %s" % (", ".join(table.c.keys()), table.name)))
+            ]
+        for table in reversed(tables):
+            sync_conn.execute(text("DROP TABLE %s" % table.name))
+            sync_conn.execute(text("DROP TABLE IF EXISTS %s_search" % table.name))
+        Base.metadata.create_all(sync_conn, tables=tables)
+        for table in tables:
+            for row in rows[table.name]:
+                for name in ("id", "main_menu_id", "submenu_id"):
+                    if row.get(name) is not None:
+                        row[name] = legacy_uuid(row[name])
+                if "price" in row:
+                    row["price"] = legacy_price(row["price"])
+            if rows[table.name]:
+                sync_conn.execute(table.insert(), rows[table.name])
+
+    await conn.run_sync(rebuild)
+
+
+def legacy_uuid(value):
+    if re.match(LEGACY_UUID, value, re.IGNORECASE):
+        return str(uuid.UUID(value))
+    return str(uuid.UUID(hashlib.md5(value.encode()).hexdigest()))
+
+
+def legacy_price(value):
+    if value is None or not re.match(LEGACY_PRICE, value):
+        return None
+    return Decimal(value.strip()).quantize(Decimal("0.01"))
+
+
+# (version, description, coroutine run with the connection), in order
+MIGRATIONS = [
+    (1, "submenu and dish counters, full-text search", add_counters_and_search),
+    (2, "uuid ids, numeric prices", uuid_keys_and_numeric_prices),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# python -m db.migrations, e.g. as a deploy step before workers start with SCHEMA_MODE=verify
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(prepare_schema("migrate"))
@@ -1,5 +1,6 @@
 import uuid
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, DDL, Integer, LargeBinary, Numeric, String, ForeignKey, Index, TypeDecorator, event, func, literal_column
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
 
 from db.config import Base
@@ -16,39 +17,118 @@ def generate_uuid():
     return str(uuid.uuid4())
 
 
+class UUID(TypeDecorator):
+    # Native uuid on Postgres, 16 bytes on sqlite. Python code always sees the
+    # canonical string, so ids can go into cache keys and JSON as they are.
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return uuid.UUID(value).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return str(uuid.UUID(bytes=value))
+
+
+def search_vector(title, description):
+    # What the Postgres search matches, titles weigh more. The GIN indexes are built
+    # on this same expression, so queries have to use it as is to hit them.
+    config, empty = literal_column("'simple'::regconfig"), literal_column("''")
+    title = func.setweight(func.to_tsvector(config, func.coalesce(title, empty)), literal_column("'A'"))
+    description = func.setweight(func.to_tsvector(config, func.coalesce(description, empty)), literal_column("'B'"))
+    return title.op("||")(description)
+
+
+def sqlite_search_index(table):
+    # sqlite: an FTS5 index "<table>_search" over the table's rows, kept in sync by triggers
+    name = table.name + "_search"
+    row = "%s.rowid, %s.title, %s.description"
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, description, content='%s', content_rowid='rowid')"
+        % (name, table.name),
+        "CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN "
+        "INSERT INTO %s(rowid, title, description) VALUES (%s); END" % (name, table.name, name, row % (("new",) * 3)),
+        "CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN "
+        "INSERT INTO %s(%s, rowid, title, description) VALUES ('delete', %s); END"
+        % (name, table.name, name, name, row % (("old",) * 3)),
+        "CREATE TRIGGER %s_update AFTER UPDATE OF title, description ON %s BEGIN "
+        "INSERT INTO %s(%s, rowid, title, description) VALUES ('delete', %s); "
+        "INSERT INTO %s(rowid, title, description) VALUES (%s); END"
+        % (name, table.name, name, name, row % (("old",) * 3), name, row % (("new",) * 3)),
+    ]
+    # also run by db/migrations.py on tables created before the index existed
+    table.info["sqlite_search_ddl"] = statements
+    for statement in statements:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(table, "before_drop", DDL("DROP TABLE IF EXISTS %s" % name).execute_if(dialect="sqlite"))
+
+
 class Menu(Base):
     __tablename__ = "menus"
 
-    id = Column(String, primary_key=True, default=generate_uuid, index=True)
+    id = Column(UUID, primary_key=True, default=generate_uuid, index=True)
     title = Column(String, unique=True, index=True)
-    description = Column(String, index=True)
+    description = Column(String)
+    # kept up to date by BookDAL, fixed by db/repair_counts.py
+    submenus_count = Column(Integer, nullable=False, default=0, server_default="0")
+    dishes_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     submenus = relationship(
         "Submenu", cascade="all, delete", back_populates="main_menu", passive_deletes=True,
     )
 
+    __table_args__ = (
+        Index("ix_menus_search", search_vector(title, description), postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
+
 
 class Submenu(Base):
     __tablename__ = "submenus"
 
-    id = Column(String, primary_key=True, default=generate_uuid, index=True)
+    id = Column(UUID, primary_key=True, default=generate_uuid, index=True)
     title = Column(String, index=True)
-    description = Column(String, index=True)
-    main_menu_id = Column(String, ForeignKey("menus.id", ondelete="CASCADE"))
+    description = Column(String)
+    main_menu_id = Column(UUID, ForeignKey("menus.id", ondelete="CASCADE"))
+    dishes_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     main_menu = relationship("Menu", back_populates="submenus")
     dishes = relationship(
         "Dish", cascade="all, delete", back_populates="relate_sub", passive_deletes=True,
     )
 
+    __table_args__ = (
+        # keyset pages and dish counts of one menu
+        Index("ix_submenus_main_menu_id_id", "main_menu_id", "id"),
+        Index("ix_submenus_search", search_vector(title, description), postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
+
 
 class Dish(Base):
     __tablename__ = "dishes"
 
-    id = Column(String, primary_key=True, default=generate_uuid, index=True)
+    id = Column(UUID, primary_key=True, default=generate_uuid, index=True)
     title = Column(String, index=True)
-    description = Column(String, index=True)
-    price = Column(String)
-    submenu_id = Column(String, ForeignKey("submenus.id", ondelete="CASCADE"))
+    description = Column(String)
+    price = Column(Numeric(10, 2))
+    submenu_id = Column(UUID, ForeignKey("submenus.id", ondelete="CASCADE"))
 
     relate_sub = relationship("Submenu", back_populates="dishes")
+
+    __table_args__ = (
+        # keyset pages and dish counts of one submenu
+        Index("ix_dishes_submenu_id_id", "submenu_id", "id"),
+        Index("ix_dishes_search", search_vector(title, description), postgresql_using="gin").ddl_if(dialect="postgresql"),
+    )
+
+
+for model in (Menu, Submenu, Dish):
+    sqlite_search_index(model.__table__)
@@ -1,10 +1,41 @@
-from pydantic import BaseModel, Field
+import uuid
+from decimal import Decimal
+
+from pydantic import BaseModel, ConstrainedDecimal, Field, validator
+
+
+class UUIDStr(str):
+    # an id from a request, checked and normalized to the form the database returns
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type="string", format="uuid")
+
+    @classmethod
+    def validate(cls, value):
+        try:
+            return str(uuid.UUID(str(value)))
+        except ValueError:
+            raise ValueError("value is not a valid uuid")
+
+
+class Price(ConstrainedDecimal):
+    # numeric(10, 2) in the database, answered as a string with two decimals
+    max_digits = 10
+    decimal_places = 2
+
+    @classmethod
+    def validate(cls, value):
+        return super().validate(value).quantize(Decimal("0.01"))
 
 
 class DishBase(BaseModel):
     title: str = Field(example="Dish")
     description: str | None = Field(example="Main dish")
-    price: str | None = Field(example="10.20")
+    price: Price | None = Field(example="10.20")
 
     class Config:
         schema_extra = {
@@ -23,6 +54,7 @@ class DishCreate(DishBase):
 class Dish(DishBase):
     id: str
     submenu_id: str
+    price: str | None = Field(example="10.20")
 
     class Config:
         orm_mode = True
@@ -78,3 +110,105 @@ class Menu(MenuBase):
 
     class Config:
         orm_mode = True
+
+
+class SubmenuTree(SubmenuBase):
+    id: str
+    main_menu_id: str
+    dishes: list[Dish] = []
+
+
+class MenuTree(MenuBase):
+    id: str
+    submenus: list[SubmenuTree] = []
+
+
+# Records of the NDJSON import, one {"type": "menu" | "submenu" | "dish", ...} per line.
+# Parents must come before their children, id is generated when missing.
+class MenuRecord(MenuBase):
+    id: UUIDStr | None = None
+
+
+class SubmenuRecord(SubmenuBase):
+    id: UUIDStr | None = None
+    main_menu_id: UUIDStr
+
+
+class DishRecord(DishBase):
+    id: UUIDStr | None = None
+    submenu_id: UUIDStr
+
+
+# Batch endpoints: creates and partial updates applied in one transaction.
+# Results come back in request order, one per item.
+BATCH_MAX_SIZE = 1000
+
+
+def title_not_null(value):
+    # a title may be left out of an update, but the column can't be set to null
+    if value is None:
+        raise ValueError("title may not be null")
+    return value
+
+
+class SubmenuUpdate(BaseModel):
+    id: UUIDStr
+    title: str | None = None
+    description: str | None = None
+
+    _title = validator("title", allow_reuse=True)(title_not_null)
+
+
+class SubmenuBatch(BaseModel):
+    create: list[SubmenuCreate] = Field(default=[], max_items=BATCH_MAX_SIZE)
+    update: list[SubmenuUpdate] = Field(default=[], max_items=BATCH_MAX_SIZE)
+
+
+class DishBatchCreate(DishBase):
+    submenu_id: UUIDStr
+
+
+class DishUpdate(BaseModel):
+    id: UUIDStr
+    title: str | None = None
+    description: str | None = None
+    price: Price | None = None
+
+    _title = validator("title", allow_reuse=True)(title_not_null)
+
+
+class DishBatch(BaseModel):
+    create: list[DishBatchCreate] = Field(default=[], max_items=BATCH_MAX_SIZE)
+    update: list[DishUpdate] = Field(default=[], max_items=BATCH_MAX_SIZE)
+
+
+class SubmenuResult(BaseModel):
+    status: int
+    detail: str | None = None
+    item: Submenu | None = None
+
+
+class SubmenuBatchResult(BaseModel):
+    create: list[SubmenuResult] = []
+    update: list[SubmenuResult] = []
+
+
+class DishResult(BaseModel):
+    status: int
+    detail: str | None = None
+    item: Dish | None = None
+
+
+class DishBatchResult(BaseModel):
+    create: list[DishResult] = []
+    update: list[DishResult] = []
+
+
+class SearchResult(BaseModel):
+    kind: str = Field(example="dish")
+    id: str
+    title: str
+    description: str | None
+    price: str | None = None
+    menu_id: str
+    submenu_id: str | None = None
@@ -0,0 +1,16 @@
+import asyncio
+
+from db.config import async_session
+from db.dals.book_dal import BookDAL
+
+
+# python -m db.repair_counts
+# recounts submenus and dishes of every menu, after manual edits or to backfill the columns
+async def main():
+    async with async_session() as session:
+        async with session.begin():
+            print(await BookDAL(session).repair_counts())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
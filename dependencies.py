@@ -1,8 +1,17 @@
-from db.config import async_session
+from db.config import async_session, read_session
 from db.dals.book_dal import BookDAL
 
 
+# sessions only check out a connection on their first query, and begin()/commit
+# without one are no-ops, so requests answered from the cache never touch the pool
 async def get_book_dal():
     async with async_session() as session:
         async with session.begin():
-            yield BookDAL(session)
\ No newline at end of file
+            yield BookDAL(session)
+
+
+async def get_read_book_dal():
+    # no explicit transaction, closing the sessions just returns the connections.
+    # Cached entries are loaded on the primary, only uncached reads use the replica.
+    async with async_session() as session, read_session() as replica_session:
+        yield BookDAL(session, replica_session)
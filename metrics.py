@@ -0,0 +1,188 @@
+import functools
+import inspect
+import os
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from starlette.responses import Response
+
+# the BookDAL method running in this task, "none" outside of one
+dal_method = ContextVar("dal_method", default="none")
+# [statements, seconds] spent in SQL by the current request
+request_db = ContextVar("request_db", default=None)
+
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time until the last byte of the response", ["method", "route"],
+)
+HTTP_REQUESTS = Counter("http_requests_total", "Responses by status code", ["method", "route", "status"])
+
+DB_STATEMENTS = Counter("db_statements_total", "SQL statements executed", ["dal_method"])
+DB_LATENCY = Histogram("db_statement_duration_seconds", "Time per SQL statement", ["dal_method"])
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements per request", ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, float("inf")),
+)
+REQUEST_DB_LATENCY = Histogram("http_request_db_duration_seconds", "Time spent in SQL per request", ["method", "route"])
+
+CASHE_LOOKUPS = Counter("cashe_lookups_total", "Cache reads by result: local_hit, hit or miss", ["dal_method", "result"])
+CASHE_SETS = Counter("cashe_sets_total", "Cache writes by result: stored, or fenced by a concurrent invalidation", ["dal_method", "result"])
+CASHE_DELETES = Counter("cashe_deletes_total", "Cache keys dropped by invalidation", ["dal_method"])
+CASHE_ERRORS = Counter("cashe_errors_total", "Redis errors, the cache is skipped when they repeat", ["dal_method"])
+CASHE_SKIPPED = Counter("cashe_skipped_total", "Cache operations skipped while Redis is unavailable", ["dal_method"])
+CASHE_READ_BYTES = Counter("cashe_read_bytes_total", "Bytes of cached values read from Redis, as stored", ["dal_method"])
+CASHE_STORED_BYTES = Counter("cashe_stored_bytes_total", "Bytes of values written to Redis, as stored", ["dal_method"])
+CASHE_WRITE_BEHIND = Counter(
+    "cashe_write_behind_jobs_total", "Cache work after writes: queued, inline when the queue is full or write-behind is off, failed",
+    ["result"],
+)
+CASHE_WRITE_BEHIND_BATCH = Histogram(
+    "cashe_write_behind_batch_jobs", "Write-behind jobs applied together by the worker",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf")),
+)
+CHANGES_SUBSCRIBERS = Gauge(
+    "changes_subscribers", "Clients connected to the change feed", multiprocess_mode="livesum",
+)
+CHANGES_CATCH_UPS = Counter(
+    "changes_catch_ups_total", "Change feed clients that read missed events: resumed, or reset when they were trimmed",
+    ["result"],
+)
+CASHE_LATENCY = Histogram(
+    "cashe_operation_duration_seconds", "Time per cache operation, encode is serialization", ["dal_method", "operation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, float("inf")),
+)
+
+
+class timed():
+    # with timed(CASHE_LATENCY, "get"): observes the block under the current DAL method
+    __slots__ = ("histogram", "operation", "start")
+
+    def __init__(self, histogram, operation):
+        self.histogram = histogram
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.labels(dal_method.get(), self.operation).observe(time.perf_counter() - self.start)
+
+
+def instrument_dal(cls):
+    # label everything a public coroutine method does with its name; a method
+    # called from another one keeps the caller's name
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_"):
+            continue
+        if inspect.isasyncgenfunction(method):
+            setattr(cls, name, _label_asyncgen(name, method))
+        elif inspect.iscoroutinefunction(method):
+            setattr(cls, name, label(name)(method))
+    return cls
+
+
+def label(name):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if dal_method.get() != "none":
+                return await func(*args, **kwargs)
+            token = dal_method.set(name)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                dal_method.reset(token)
+        return wrapper
+    return decorator
+
+
+def _label_asyncgen(name, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        try:
+            while True:
+                # set around every step, the consumer may run each one in a different context
+                token = dal_method.set(name) if dal_method.get() == "none" else None
+                try:
+                    item = await gen.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    if token is not None:
+                        dal_method.reset(token)
+                yield item
+        finally:
+            await gen.aclose()
+    return wrapper
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        method = dal_method.get()
+        DB_STATEMENTS.labels(method).inc()
+        DB_LATENCY.labels(method).observe(elapsed)
+        stats = request_db.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(context):
+        # the statement failed, after_cursor_execute won't run
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+class MetricsMiddleware():
+    # plain ASGI, so streamed responses are timed to their last chunk
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        stats = [0, 0.0]
+        token = request_db.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_db.reset(token)
+            method, route = scope["method"], self.route(scope)
+            HTTP_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route, status).inc()
+            REQUEST_DB_STATEMENTS.labels(method, route).observe(stats[0])
+            REQUEST_DB_LATENCY.labels(method, route).observe(stats[1])
+
+    def route(self, scope):
+        # the path template of the matched route, never the raw path with its ids
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self.routes.get(scope.get("endpoint"), "unmatched")
+
+
+def metrics_response():
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # several workers, sum up their files
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -1,16 +1,116 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from starlette import status
 
-from db.dals.book_dal import BookDAL
+from db.cashe import cashe, changes
+from db.dals.book_dal import BookDAL, PAGE_SIZE, MAX_PAGE_SIZE, SEARCH_KINDS, import_records
 from db.models.book import Book
-from dependencies import get_book_dal
+from dependencies import get_book_dal, get_read_book_dal
 from db.models import schemas
 
 router = APIRouter()
 
 
+def json_response(body: bytes, headers: dict | None = None) -> Response:
+    # body is already encoded json from the cache, skip validation and serialization
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def stream_response(chunks, headers: dict | None = None) -> StreamingResponse:
+    # a json list written while it is read, for lists too long to build in memory
+    return StreamingResponse(chunks, media_type="application/json", headers=headers)
+
+
+# clients may keep GET responses but have to revalidate them, which is a cheap 304
+CACHE_CONTROL = "no-cache"
+
+
+async def current_etag(name: str) -> str | None:
+    # "menus" for the menu list, "menu:<id>" for anything inside a menu, see BookDAL.commit.
+    # None until something has been written there or found_response has made a version.
+    version, = await cashe.get_versions(name)
+    return make_etag(version)
+
+
+def make_etag(version: int | None) -> str | None:
+    # None without a version or while Redis is unavailable: no ETag is sent and nothing is answered with 304
+    return None if version is None else '"%s"' % version
+
+
+def cache_headers(etag: str | None, next_cursor: str | None = None) -> dict:
+    headers = {"Cache-Control": CACHE_CONTROL}
+    if etag is not None:
+        headers["ETag"] = etag
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return headers
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag))
+
+
+def etag_matches(request: Request, etag: str | None, found: bool = False) -> bool:
+    # "*" matches any current representation, so only once the request has found one
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return found
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+async def found_response(request: Request, name: str, etag: str | None, body: bytes, next_cursor: str | None = None) -> Response:
+    # The answer to a GET that has found what it reads. Without a version yet, one is made
+    # for it now: only what exists gets a version, see cashe.create_version.
+    if etag is None:
+        etag = make_etag(await cashe.create_version(name))
+    if etag_matches(request, etag, found=True):
+        return not_modified(etag)
+    return json_response(body, cache_headers(etag, next_cursor))
+
+
+async def submenu_in_menu(book_dal: BookDAL, submenu_id: str, menu_id: str) -> bytes:
+    # The submenu's body, 404 unless it is in the path's menu: the ETag is that menu's
+    # version, which writes to a submenu of another menu don't bump. Only checked on
+    # the way to a 200, a 304 sends nothing.
+    db_submenu = await book_dal.get_submenu(submenu_id=submenu_id)
+    if not db_submenu or orjson.loads(db_submenu)["main_menu_id"] != menu_id:
+        raise HTTPException(status_code=404, detail="submenu not found")
+    return db_submenu
+
+
+RECORD_SCHEMAS = {"menu": schemas.MenuRecord, "submenu": schemas.SubmenuRecord, "dish": schemas.DishRecord}
+
+
+async def read_records(request: Request):
+    # parse the NDJSON body line by line as it arrives
+    line_number = 0
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield (line_number, *parse_record(line, line_number))
+    if buffer.strip():
+        yield (line_number + 1, *parse_record(buffer, line_number + 1))
+
+
+def parse_record(line: bytes, line_number: int):
+    try:
+        record = orjson.loads(line)
+        record_type = record.pop("type")
+        return record_type, RECORD_SCHEMAS[record_type](**record).dict()
+    except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError, ValidationError) as e:
+        raise HTTPException(status_code=422, detail="line %s: invalid record (%s)" % (line_number, e))
+
+
 # @router.post("/books")
 # async def create_book(name: str, author: str, release_year: int, book_dal: BookDAL = Depends(get_book_dal)):
 #     return await book_dal.create_book(name, author, release_year)
@@ -27,12 +127,18 @@ router = APIRouter()
     # return await book_dal.get_all_books()
 
 @router.get("/api/v1/menus",
-    # response_model=list[schemas.Menu],
+    response_model=list[schemas.Menu],
     summary="Get all menus",
-    description="You can look all of the menus",
+    description="You can look all of the menus. "
+    "With stream=true the list is sent as it is read from the database instead of from the cache",
 )
-async def read_menus(book_dal: BookDAL = Depends(get_book_dal)):
-    return await book_dal.get_menus()
+async def read_menus(request: Request, stream: bool = False, book_dal: BookDAL = Depends(get_read_book_dal)):
+    etag = await current_etag("menus")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    if stream:
+        return stream_response(book_dal.stream_menus(), cache_headers(etag))
+    return await found_response(request, "menus", etag, await book_dal.get_menus())
 
 @router.post(
     "/api/v1/menus",
@@ -48,15 +154,18 @@ async def create_menu(menu: schemas.MenuCreate, book_dal: BookDAL = Depends(get_
 
 @router.get(
     "/api/v1/menus/{api_test_menu_id}",
-    # response_model=schemas.Menu,
+    response_model=schemas.Menu,
     summary="Get one menu",
     description="You can look at the menu",
 )
-async def read_menu(api_test_menu_id: str, book_dal: BookDAL = Depends(get_book_dal)):
+async def read_menu(api_test_menu_id: schemas.UUIDStr, request: Request, book_dal: BookDAL = Depends(get_read_book_dal)):
+    etag = await current_etag("menu:" + api_test_menu_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
     db_menu = await book_dal.get_menu(menu_id=api_test_menu_id)
     if not db_menu:
         raise HTTPException(status_code=404, detail="menu not found")
-    return db_menu
+    return await found_response(request, "menu:" + api_test_menu_id, etag, db_menu)
 
 @router.patch(
     "/api/v1/menus/{api_test_menu_id}",
@@ -64,32 +173,59 @@ async def read_menu(api_test_menu_id: str, book_dal: BookDAL = Depends(get_book_
     summary="Get one menu for update",
     description="You can update the menu with all the information, title, description",
 )
-async def update_menu(api_test_menu_id: str, menu: schemas.MenuBase, book_dal: BookDAL = Depends(get_book_dal)):
-    db_menu = await book_dal.get_menu(menu_id=api_test_menu_id)
+async def update_menu(api_test_menu_id: schemas.UUIDStr, menu: schemas.MenuBase, book_dal: BookDAL = Depends(get_book_dal)):
+    db_menu = await book_dal.update_menu(menu=menu, api_test_menu_id=api_test_menu_id)
     if db_menu is None:
         raise HTTPException(status_code=404, detail="menu not found")
-    return await book_dal.update_menu(menu=menu, api_test_menu_id=api_test_menu_id)
+    return json_response(db_menu)
 
 @router.delete(
     "/api/v1/menus/{api_test_menu_id}",
     summary="Get one menu for delete",
     description="You can delete the menu with all submenus and dishes",
 )
-async def delete_menu(api_test_menu_id: str, book_dal: BookDAL = Depends(get_book_dal)):
-    db_menu = await book_dal.get_menu(menu_id=api_test_menu_id)
-    if db_menu is None:
-        raise HTTPException(status_code=404, detail="menu not found")
+async def delete_menu(api_test_menu_id: schemas.UUIDStr, book_dal: BookDAL = Depends(get_book_dal)):
     res = await book_dal.delete_menu(menu_id=api_test_menu_id)
+    if res is None:
+        raise HTTPException(status_code=404, detail="menu not found")
     return res
 
+@router.get(
+    "/api/v1/menus/{api_test_menu_id}/tree",
+    response_model=schemas.MenuTree,
+    summary="Get one menu with all submenus and dishes",
+    description="You can look at the whole menu in one request. "
+    "Send the ETag back in If-None-Match to get 304 while the menu is unchanged",
+)
+async def read_menu_tree(api_test_menu_id: schemas.UUIDStr, request: Request, book_dal: BookDAL = Depends(get_read_book_dal)):
+    version, = await cashe.get_versions("menu:" + api_test_menu_id)
+    etag = make_etag(version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    db_tree = await book_dal.get_menu_tree(menu_id=api_test_menu_id, version=version)
+    if db_tree is None:
+        raise HTTPException(status_code=404, detail="menu not found")
+    return await found_response(request, "menu:" + api_test_menu_id, etag, db_tree)
+
 @router.get(
     "/api/v1/menus/{api_test_menu_id}/submenus/",
     response_model=list[schemas.Submenu],
     summary="Get all submenus",
-    description="You can look all information about the submenus",
+    description="You can look all information about the submenus. "
+    "Pass the X-Next-Cursor header value as cursor to get the next page",
 )
-async def read_submenus(book_dal: BookDAL = Depends(get_book_dal)):
-    return await book_dal.get_submenus()
+async def read_submenus(
+    api_test_menu_id: schemas.UUIDStr, request: Request, cursor: schemas.UUIDStr | None = None,
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), book_dal: BookDAL = Depends(get_read_book_dal),
+):
+    etag = await current_etag("menu:" + api_test_menu_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    body, next_cursor = await book_dal.get_submenus(menu_id=api_test_menu_id, cursor=cursor, limit=limit)
+    if body == b"[]":
+        # the menu may not exist, nothing is found
+        return json_response(body, cache_headers(etag, next_cursor))
+    return await found_response(request, "menu:" + api_test_menu_id, etag, body, next_cursor)
 
 @router.post(
     "/api/v1/menus/{api_test_menu_id}/submenus/", 
@@ -99,21 +235,37 @@ async def read_submenus(book_dal: BookDAL = Depends(get_book_dal)):
     description="Create an submenu with all the information, title, description",
 )
 async def create_submenu(
-    api_test_menu_id: str, submenu: schemas.SubmenuCreate, book_dal: BookDAL = Depends(get_book_dal),
+    api_test_menu_id: schemas.UUIDStr, submenu: schemas.SubmenuCreate, book_dal: BookDAL = Depends(get_book_dal),
 ):
     return await book_dal.create_submenu(submenu=submenu, main_menu_id=api_test_menu_id)
 
+@router.post(
+    "/api/v1/menus/{api_test_menu_id}/submenus/batch",
+    response_model=schemas.SubmenuBatchResult,
+    summary="Create and update submenus in one request",
+    description="Applies every create and update in one transaction. Updates change only the fields sent. "
+    "Results follow the request order, with a status per item",
+)
+async def batch_submenus(api_test_menu_id: schemas.UUIDStr, batch: schemas.SubmenuBatch, book_dal: BookDAL = Depends(get_book_dal)):
+    result = await book_dal.batch_submenus(menu_id=api_test_menu_id, creates=batch.create, updates=batch.update)
+    if result is None:
+        raise HTTPException(status_code=404, detail="menu not found")
+    return json_response(cashe.encode(result))
+
 @router.get(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}",
     response_model=schemas.Submenu,
     summary="Get one submenu",
     description="You can look information about the submenu",
 )
-async def read_submenu(api_test_submenu_id: str, book_dal: BookDAL = Depends(get_book_dal)):
-    db_submenu = await book_dal.get_submenu(submenu_id=api_test_submenu_id)
-    if not db_submenu:
-        raise HTTPException(status_code=404, detail="submenu not found")
-    return db_submenu
+async def read_submenu(
+    api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, request: Request, book_dal: BookDAL = Depends(get_read_book_dal),
+):
+    etag = await current_etag("menu:" + api_test_menu_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    db_submenu = await submenu_in_menu(book_dal, api_test_submenu_id, api_test_menu_id)
+    return await found_response(request, "menu:" + api_test_menu_id, etag, db_submenu)
 
 @router.patch(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}",
@@ -121,22 +273,22 @@ async def read_submenu(api_test_submenu_id: str, book_dal: BookDAL = Depends(get
     summary="Get one submenu for update",
     description="You can update the submenu with all the information, title, description",
 )
-async def update_submenu(api_test_submenu_id: str, submenu: schemas.SubmenuBase, book_dal: BookDAL = Depends(get_book_dal)):
-    db_submenu = await book_dal.get_submenu(submenu_id=api_test_submenu_id)
+async def update_submenu(api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, submenu: schemas.SubmenuBase, book_dal: BookDAL = Depends(get_book_dal)):
+    db_submenu = await book_dal.update_submenu(submenu=submenu, api_test_submenu_id=api_test_submenu_id, api_test_menu_id=api_test_menu_id)
     if db_submenu is None:
         raise HTTPException(status_code=404, detail="submenu not found")
-    return await book_dal.update_submenu(submenu=submenu, api_test_submenu_id=api_test_submenu_id)
+    return json_response(db_submenu)
 
 @router.delete(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}",
     summary="Delete one submenu",
     description="You can delete the menu with all dishes",
 )
-async def delete_submenu(api_test_submenu_id: str, api_test_menu_id: str, book_dal: BookDAL = Depends(get_book_dal)):
-    db_submenu = await book_dal.get_submenu(submenu_id=api_test_submenu_id)
-    if db_submenu is None:
+async def delete_submenu(api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, book_dal: BookDAL = Depends(get_book_dal)):
+    res = await book_dal.delete_submenu(submenu_id=api_test_submenu_id, menu_id=api_test_menu_id)
+    if res is None:
         raise HTTPException(status_code=404, detail="submenu not found")
-    return await book_dal.delete_submenu(submenu_id=api_test_submenu_id, menu_id=api_test_menu_id)
+    return res
 
 @router.post(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}/dishes",
@@ -144,18 +296,46 @@ async def delete_submenu(api_test_submenu_id: str, api_test_menu_id: str, book_d
     summary="Create a dish",
     description="Create a dish with all the information, title, description, price",
 )
-async def create_dish(api_test_submenu_id: str, api_test_menu_id: str, dish: schemas.DishCreate, book_dal: BookDAL = Depends(get_book_dal)):
-    return await book_dal.create_dish(dish=dish, submenu_id=api_test_submenu_id, menu_id=api_test_menu_id)
+async def create_dish(api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, dish: schemas.DishCreate, book_dal: BookDAL = Depends(get_book_dal)):
+    db_dish = await book_dal.create_dish(dish=dish, submenu_id=api_test_submenu_id, menu_id=api_test_menu_id)
+    if db_dish is None:
+        raise HTTPException(status_code=404, detail="submenu not found")
+    return db_dish
+
+@router.post(
+    "/api/v1/menus/{api_test_menu_id}/dishes/batch",
+    response_model=schemas.DishBatchResult,
+    summary="Create and update dishes of a menu in one request",
+    description="Applies every create and update in one transaction, e.g. repricing a whole menu. "
+    "Updates change only the fields sent. Results follow the request order, with a status per item",
+)
+async def batch_dishes(api_test_menu_id: schemas.UUIDStr, batch: schemas.DishBatch, book_dal: BookDAL = Depends(get_book_dal)):
+    result = await book_dal.batch_dishes(menu_id=api_test_menu_id, creates=batch.create, updates=batch.update)
+    if result is None:
+        raise HTTPException(status_code=404, detail="menu not found")
+    return json_response(cashe.encode(result))
 
 @router.get(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}/dishes",
     response_model=list[schemas.Dish],
     summary="Get all dishes",
-    description="You can look all information about the dishes",
+    description="You can look all information about the dishes. "
+    "Pass the X-Next-Cursor header value as cursor to get the next page. "
+    "With stream=true every dish comes in one response, sent as it is read from the database",
 )
-async def read_dishes(book_dal: BookDAL = Depends(get_book_dal)):
-    dishes = await book_dal.get_dishes()
-    return dishes
+async def read_dishes(
+    api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, request: Request, cursor: schemas.UUIDStr | None = None,
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), stream: bool = False,
+    book_dal: BookDAL = Depends(get_read_book_dal),
+):
+    etag = await current_etag("menu:" + api_test_menu_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    await submenu_in_menu(book_dal, api_test_submenu_id, api_test_menu_id)
+    if stream:
+        return stream_response(book_dal.stream_dishes(submenu_id=api_test_submenu_id), cache_headers(etag))
+    body, next_cursor = await book_dal.get_dishes(submenu_id=api_test_submenu_id, cursor=cursor, limit=limit)
+    return await found_response(request, "menu:" + api_test_menu_id, etag, body, next_cursor)
 
 @router.get(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}/dishes/{api_test_dish_id}",
@@ -163,9 +343,19 @@ async def read_dishes(book_dal: BookDAL = Depends(get_book_dal)):
     summary="Get one dish",
     description="You can look all information about the dish",
 )
-async def read_dish(api_test_dish_id: str, book_dal: BookDAL = Depends(get_book_dal)):
+async def read_dish(
+    api_test_dish_id: schemas.UUIDStr, api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr,
+    request: Request, book_dal: BookDAL = Depends(get_read_book_dal),
+):
+    etag = await current_etag("menu:" + api_test_menu_id)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    # the dish has to be in the path's submenu and that in the path's menu, see submenu_in_menu
     db_dish = await book_dal.get_dish(dish_id=api_test_dish_id)
-    return db_dish
+    if orjson.loads(db_dish)["submenu_id"] != api_test_submenu_id:
+        raise HTTPException(status_code=404, detail="dish not found")
+    await submenu_in_menu(book_dal, api_test_submenu_id, api_test_menu_id)
+    return await found_response(request, "menu:" + api_test_menu_id, etag, db_dish)
 
 @router.patch(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}/dishes/{api_test_dish_id}",
@@ -173,20 +363,75 @@ async def read_dish(api_test_dish_id: str, book_dal: BookDAL = Depends(get_book_
     summary="Get one dish for update",
     description="You can update the dish with all the information, title, description, price",
 )
-async def update_dish(api_test_dish_id: str, api_test_submenu_id: str, api_test_menu_id: str, dish: schemas.DishBase, book_dal: BookDAL = Depends(get_book_dal)):
-    db_dish = await book_dal.get_dish(dish_id=api_test_dish_id)
+async def update_dish(api_test_dish_id: schemas.UUIDStr, api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, dish: schemas.DishBase, book_dal: BookDAL = Depends(get_book_dal)):
+    db_dish = await book_dal.update_dish(dish=dish, api_test_dish_id=api_test_dish_id, api_test_submenu_id=api_test_submenu_id, api_test_menu_id=api_test_menu_id)
     if db_dish is None:
         raise HTTPException(status_code=404, detail="dish not found")
-    return await book_dal.update_dish(dish=dish, api_test_dish_id=api_test_dish_id, api_test_submenu_id=api_test_submenu_id, api_test_menu_id=api_test_menu_id)
+    return json_response(db_dish)
 
 @router.delete(
     "/api/v1/menus/{api_test_menu_id}/submenus/{api_test_submenu_id}/dishes/{api_test_dish_id}",
     summary="Delete one dish",
     description="You can delete the dish",
 )
-async def delete_dish(api_test_dish_id: str, api_test_submenu_id: str, api_test_menu_id: str, book_dal: BookDAL = Depends(get_book_dal)):
-    db_dish = await book_dal.get_dish(dish_id=api_test_dish_id)
-    if db_dish is None:
+async def delete_dish(api_test_dish_id: schemas.UUIDStr, api_test_submenu_id: schemas.UUIDStr, api_test_menu_id: schemas.UUIDStr, book_dal: BookDAL = Depends(get_book_dal)):
+    res = await book_dal.delete_dish(dish_id=api_test_dish_id, api_test_submenu_id=api_test_submenu_id, api_test_menu_id=api_test_menu_id)
+    if res is None:
         raise HTTPException(status_code=404, detail="dish not found")
-    return await book_dal.delete_dish(dish_id=api_test_dish_id, api_test_submenu_id=api_test_submenu_id, api_test_menu_id=api_test_menu_id)
+    return res
+
+@router.get(
+    "/api/v1/search",
+    response_model=list[schemas.SearchResult],
+    summary="Search menus, submenus and dishes",
+    description="Matches titles and descriptions containing words that start with every word of q, "
+    "best matches first. kind limits the result to some of menu, submenu, dish, menu_id to one menu. "
+    "Pass the X-Next-Cursor header value as cursor to get the next page",
+)
+async def search(
+    q: str = Query(min_length=1, max_length=200), kind: list[str] = Query(default=list(SEARCH_KINDS)),
+    menu_id: schemas.UUIDStr | None = None, cursor: str | None = None,
+    limit: int = Query(default=PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), book_dal: BookDAL = Depends(get_read_book_dal),
+):
+    unknown = set(kind) - set(SEARCH_KINDS)
+    if unknown:
+        raise HTTPException(status_code=422, detail="unknown kind %s" % ", ".join(sorted(unknown)))
+    body, next_cursor = await book_dal.search(terms=q, kinds=list(dict.fromkeys(kind)), menu_id=menu_id, cursor=cursor, limit=limit)
+    return json_response(body, {"X-Next-Cursor": next_cursor} if next_cursor else None)
 
+@router.post(
+    "/api/v1/import",
+    summary="Import menus, submenus and dishes",
+    description="Send NDJSON, one {\"type\": \"menu\" | \"submenu\" | \"dish\", ...} object per line, "
+    "parents before their children. Rows are upserted by id in batches, "
+    "so a failed import can simply be sent again. A record whose parent is missing fails it with 422, "
+    "one that conflicts with other rows, such as a menu title already in use, with 409; "
+    "the error names the line, the batches before it stay imported",
+)
+async def import_menus(request: Request):
+    return await import_records(read_records(request))
+
+@router.get(
+    "/api/v1/export",
+    summary="Export menus, submenus and dishes",
+    description="NDJSON stream of every menu, submenu and dish in the import format",
+)
+async def export_menus(book_dal: BookDAL = Depends(get_read_book_dal)):
+    return StreamingResponse(book_dal.export_records(), media_type="application/x-ndjson")
+
+
+@router.get(
+    "/api/v1/changes",
+    summary="Follow changes to menus, submenus and dishes",
+    description="Server-Sent Events instead of polling: a \"change\" event per created, updated or deleted "
+    "menu, submenu or dish, optionally only those of one menu. A reconnecting client gets the changes it "
+    "missed from Last-Event-ID or since; \"ready\" and \"reset\" events mean it should load everything, "
+    "as does a change with op \"reload\"",
+)
+async def read_changes(request: Request, menu_id: schemas.UUIDStr | None = None, since: str | None = None):
+    since = request.headers.get("last-event-id") or since
+    return StreamingResponse(
+        changes.stream_changes(menu_id, since), media_type="text/event-stream",
+        # proxies such as nginx would otherwise hold the events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import uvicorn
+from prometheus_client import multiprocess
+from uvicorn._subprocess import get_subprocess, spawn
+
+from db.config import SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_BACKLOG, SERVER_KEEP_ALIVE
+from db.config import SERVER_LIMIT_CONCURRENCY, SERVER_GRACEFUL_TIMEOUT, SERVER_ACCESS_LOG
+from db.cashe import changes
+
+# Production entry point: python server.py
+# The parent binds the socket and watches SERVER_WORKERS worker processes, each with
+# its own uvloop event loop and httptools parser. Workers are spawned, not forked, so
+# each one imports the app and creates its engine and Redis pools itself: nothing
+# opened in the parent is shared. app.py's __main__ is for development.
+
+logger = logging.getLogger("uvicorn.error")
+
+# seconds left to a worker after SERVER_GRACEFUL_TIMEOUT for the app's own shutdown
+SHUTDOWN_MARGIN = 10
+
+
+class Server(uvicorn.Server):
+    # ready is set once the app has started and the worker accepts connections.
+    # uvicorn waits for every open connection when it stops; change feeds would keep it
+    # waiting forever, and a slow request after SERVER_GRACEFUL_TIMEOUT is cut off.
+    def __init__(self, config: uvicorn.Config, ready):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        if not self.should_exit:
+            self.ready.set()
+
+    async def shutdown(self, sockets=None):
+        changes.close_subscriptions()
+        timer = asyncio.get_running_loop().call_later(SERVER_GRACEFUL_TIMEOUT, self.close_connections)
+        try:
+            await super().shutdown(sockets)
+        finally:
+            timer.cancel()
+
+    def close_connections(self):
+        connections = list(self.server_state.connections)
+        logger.warning("closing %s connections still open after %ss", len(connections), SERVER_GRACEFUL_TIMEOUT)
+        for connection in connections:
+            connection.transport.close()
+
+
+class Supervisor():
+    # Starts the workers and starts another one when a worker dies, but stops when one
+    # dies before it is ready: the app can't start (schema, database, configuration).
+    # On SIGTERM or SIGINT the workers get SIGTERM and drain, the ones still running
+    # afterwards are killed.
+    def __init__(self, config: uvicorn.Config, sockets: list, metrics_dir: str):
+        self.config = config
+        self.sockets = sockets
+        self.metrics_dir = metrics_dir
+        # index -> (process, ready event)
+        self.workers = {}
+        self.should_exit = threading.Event()
+
+    def run(self) -> int:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *args: self.should_exit.set())
+        for index in range(self.config.workers):
+            self.start(index)
+        failed = False
+        while not failed and not self.should_exit.wait(0.5):
+            for index, (process, ready) in list(self.workers.items()):
+                if process.is_alive():
+                    continue
+                self.exited(process)
+                if not ready.is_set():
+                    logger.error("worker %s failed to start (exit code %s), stopping", process.pid, process.exitcode)
+                    failed = True
+                    break
+                logger.warning("worker %s died (exit code %s), starting another", process.pid, process.exitcode)
+                self.start(index)
+        self.stop()
+        return 1 if failed else 0
+
+    def start(self, index: int):
+        ready = spawn.Event()
+        process = get_subprocess(config=self.config, target=Server(self.config, ready).run, sockets=self.sockets)
+        process.start()
+        self.workers[index] = (process, ready)
+
+    def stop(self):
+        for process, _ in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + SERVER_GRACEFUL_TIMEOUT + SHUTDOWN_MARGIN
+        for process, _ in self.workers.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error("worker %s did not stop in time, killing it", process.pid)
+                process.kill()
+                process.join()
+            self.exited(process)
+
+    def exited(self, process):
+        # its live gauges, such as the change feed clients, no longer count
+        multiprocess.mark_process_dead(process.pid, self.metrics_dir)
+
+
+def prepare_metrics_dir():
+    # Workers write their metrics to files in PROMETHEUS_MULTIPROC_DIR, /metrics adds
+    # them up. Returns the directory and whether it was created here.
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path is None:
+        path = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+        return path, True
+    # files of an earlier run would be added up too
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+    return path, False
+
+
+def main() -> int:
+    config = uvicorn.Config(
+        "app:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS,
+        loop="uvloop", http="httptools", lifespan="on",
+        backlog=SERVER_BACKLOG, timeout_keep_alive=SERVER_KEEP_ALIVE,
+        limit_concurrency=SERVER_LIMIT_CONCURRENCY, access_log=SERVER_ACCESS_LOG,
+    )
+    metrics_dir, created = prepare_metrics_dir()
+    sockets = [config.bind_socket()]
+    logger.info("starting %s workers on %s:%s", config.workers, SERVER_HOST, SERVER_PORT)
+    try:
+        return Supervisor(config, sockets, metrics_dir).run()
+    finally:
+        for sock in sockets:
+            sock.close()
+        if created:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())